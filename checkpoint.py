@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import random
+import threading
+
+import numpy as np
+import torch
+
+from loguru import logger
+
+
+LAST_CHECKPOINT = "last.tar"
+# General options that do not change the training trajectory, so they may differ when resuming.
+RESUME_IGNORED_OPTIONS = {
+    "tracking_uri", "device", "tqdm", "num_epochs", "patience", "num_workers", "persistent_workers",
+    "shared_loader_workers", "prefetch_batches", "feature_cache_size", "data_cache", "cache_dir",
+    "checkpoint_dir", "checkpoint_debounce", "checkpoint_keep", "async_logging", "mlflow_spool_dir", "save_model",
+    "presample_dir",
+}
+
+
+class SnapshotManager:
+    """Keep the best and the latest model and optimizer states without reallocating them.
+
+    `snapshot` copies the current states in place into buffers allocated on the
+    first call (on the device of each tensor). If `save_dir` is given, the best
+    snapshot is also written as a checkpoint by a background thread, at most once
+    every `debounce` seconds, so only the latest of several quick improvements is
+    written. The `keep` most recent best checkpoints are retained.
+
+    `checkpoint` records the training state at the end of an epoch and the
+    training `config` (see `get_resume_config`). The model and optimizer are
+    only copied to cpu when the checkpoint is due, at most once every
+    `debounce` seconds and on `close`, and written the same way to
+    `save_dir/last.tar` to resume the run with `load`, which fails if the
+    resuming config differs. It refers to the best checkpoint as of that epoch,
+    which is retained until a later `last.tar` replaces it.
+    """
+
+    def __init__(self, model, optimizer=None, save_dir=None, debounce=30.0, keep=2, config=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.config = config
+        self.save_dir = save_dir
+        self.debounce = debounce
+        self.keep = keep
+
+        self.best_epoch = None
+        self.best_model_state = None
+        self.best_optimizer_state = None
+        self.last_state = None
+        self.last_captured = False
+        self.next_checkpoint = -float("inf")
+        self.checkpoints = []
+        # Epochs of the best snapshot copied to cpu and of the latest best checkpoint written.
+        self.captured_best_epoch = None
+        self.saved_best_epoch = None
+        # Name of the best checkpoint that the written last.tar refers to.
+        self.last_best_checkpoint = None
+
+        self.lock = threading.Lock()
+        # Held while the cpu buffers are filled or written.
+        self.write_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.closing = False
+        self.thread = None
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+            # Second set of buffers on cpu, so that writing does not block snapshots.
+            self.write_state = {}
+            self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+            self.thread.start()
+
+    @torch.no_grad()
+    def snapshot(self, epoch):
+        with self.lock:
+            self.best_epoch = epoch
+            self.best_model_state = copy_state(self.model.state_dict(), self.best_model_state)
+            if self.optimizer is not None:
+                self.best_optimizer_state = copy_state(self.optimizer.state_dict(), self.best_optimizer_state)
+        self._schedule("best")
+
+    def checkpoint(self, epoch, **training_state):
+        """Record the state to resume from after `epoch`, with extra (small) training state."""
+        if self.thread is None:
+            return
+        with self.lock:
+            self.last_state = {
+                'epoch': epoch,
+                'rng_state': get_rng_state(),
+                'config': self.config,
+                'best_epoch': self.best_epoch,
+                **training_state,
+            }
+            self.last_captured = False
+        # Skipped while the previous checkpoints are being written, to be captured at a later epoch.
+        if time.monotonic() < self.next_checkpoint or not self.write_lock.acquire(blocking=False):
+            return
+        try:
+            self._capture_last()
+        finally:
+            self.write_lock.release()
+
+    def load(self, checkpoint):
+        """Restore the model, optimizer, best snapshot and RNG states of a `last.tar` checkpoint."""
+        saved_config = checkpoint.get('config')
+        if saved_config is None:
+            logger.warning("The checkpoint has no training config to compare with; resuming without the check.")
+        elif saved_config != self.config:
+            changed = sorted(
+                f"{section}.{key}" for section in set(saved_config) | set(self.config)
+                for key in set(saved_config.get(section) or {}) | set(self.config.get(section) or {})
+                if (saved_config.get(section) or {}).get(key) != (self.config.get(section) or {}).get(key))
+            raise ValueError(f"Cannot resume: the training config differs from the checkpoint's in {', '.join(changed)}.")
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if checkpoint['best_epoch'] is not None and self.save_dir is not None:
+            best = torch.load(os.path.join(self.save_dir, checkpoint['best_checkpoint']), map_location="cpu")
+            device_state = self.model.state_dict()
+            self.best_epoch = checkpoint['best_epoch']
+            self.best_model_state = {
+                key: value.to(device_state[key].device) for key, value in best['model_state_dict'].items()}
+            self.best_optimizer_state = best['optimizer_state_dict']
+            # Already on disk: keep it in the rotation instead of writing it again.
+            self.captured_best_epoch = self.saved_best_epoch = self.best_epoch
+            self.last_best_checkpoint = checkpoint['best_checkpoint']
+            self.checkpoints = sorted(
+                (os.path.join(self.save_dir, name) for name in os.listdir(self.save_dir)
+                 if name.startswith("best-epoch") and name.endswith(".tar")
+                 and int(name.removeprefix("best-epoch").removesuffix(".tar")) <= self.best_epoch),
+                key=lambda path: int(os.path.basename(path).removeprefix("best-epoch").removesuffix(".tar")))
+        set_rng_state(checkpoint['rng_state'])
+
+    def restore(self):
+        """Load the best snapshot into the model."""
+        self.model.load_state_dict(self.best_model_state)
+
+    def latest_checkpoint(self):
+        return self.checkpoints[-1] if self.checkpoints else None
+
+    def close(self):
+        """Write the pending snapshots and stop the writer. Returns the latest best checkpoint path."""
+        if self.thread is not None:
+            with self.write_lock:
+                # The model is unchanged since the last epoch, whose checkpoint may have been skipped.
+                if self.last_state is not None and not self.last_captured:
+                    self._capture_last()
+            with self.condition:
+                self.closing = True
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        return self.latest_checkpoint()
+
+    @torch.no_grad()
+    def _capture_last(self):
+        """Copy the state of `checkpoint` to cpu, with the best snapshot it refers to if not yet copied."""
+        schedule = ["last"]
+        with self.lock:
+            if self.best_epoch is not None and self.best_epoch != self.captured_best_epoch:
+                # Later snapshots may overwrite the buffers before the writer copies them.
+                self._capture_best()
+                schedule.append("best")
+            best_checkpoint = f"best-epoch{self.best_epoch}.tar" if self.best_epoch is not None else None
+            state = {
+                **self.last_state,
+                'model_state_dict': self.model.state_dict(),
+                'optimizer_state_dict': self.optimizer.state_dict(),
+                'best_checkpoint': best_checkpoint,
+            }
+            self.write_state["last"] = copy_state(state, self.write_state.get("last"), device="cpu")
+            self.last_captured = True
+        self.next_checkpoint = time.monotonic() + self.debounce
+        for kind in schedule:
+            self._schedule(kind)
+
+    def _capture_best(self):
+        self.write_state["best"] = copy_state({
+            'epoch': self.best_epoch,
+            'model_state_dict': self.best_model_state,
+            'optimizer_state_dict': self.best_optimizer_state,
+        }, self.write_state.get("best"), device="cpu")
+        self.captured_best_epoch = self.best_epoch
+
+    def _schedule(self, kind):
+        if self.thread is not None:
+            with self.condition:
+                self.pending.add(kind)
+                self.condition.notify()
+
+    def _run(self):
+        last_write = -float("inf")
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if not self.closing:
+                    # Debounce: wait for later snapshots until the interval has passed.
+                    remaining = last_write + self.debounce - time.monotonic()
+                    if remaining > 0:
+                        self.condition.wait(timeout=remaining)
+                        if not self.closing and time.monotonic() < last_write + self.debounce:
+                            continue
+                pending, closing = self.pending, self.closing
+                self.pending = set()
+
+            # The best checkpoints are written first, as last.tar refers to them.
+            with self.write_lock:
+                if "best" in pending:
+                    self._write_best()
+                if "last" in pending and self._save(self.write_state["last"], os.path.join(self.save_dir, LAST_CHECKPOINT)):
+                    self.last_best_checkpoint = self.write_state["last"]['best_checkpoint']
+                self._rotate()
+            if pending:
+                last_write = time.monotonic()
+            if closing:
+                return
+
+    @torch.no_grad()
+    def _write_best(self):
+        """Write the best snapshot captured with `last.tar` if not written yet, then the latest one."""
+        while True:
+            with self.lock:
+                if self.captured_best_epoch == self.saved_best_epoch:
+                    if self.best_epoch == self.captured_best_epoch:
+                        break
+                    self._capture_best()
+                epoch = self.captured_best_epoch
+            path = os.path.join(self.save_dir, f"best-epoch{epoch}.tar")
+            self.saved_best_epoch = epoch
+            if not self._save(self.write_state["best"], path):
+                break
+            self.checkpoints.append(path)
+
+    def _rotate(self):
+        """Remove the best checkpoints beyond `keep`, except those referred to by the written and the captured last.tar."""
+        referred = {self.last_best_checkpoint, self.write_state.get("last", {}).get('best_checkpoint')}
+        old = self.checkpoints[:max(len(self.checkpoints) - self.keep, 0)]
+        for path in [path for path in old if os.path.basename(path) not in referred]:
+            self.checkpoints.remove(path)
+            os.remove(path)
+
+    def _save(self, state, path):
+        try:
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.warning(f"Failed to write checkpoint {path}: {e}")
+            return False
+        return True
+
+
+def load_last_checkpoint(save_dir):
+    path = os.path.join(save_dir, LAST_CHECKPOINT)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No checkpoint to resume from at {path}.")
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def get_resume_config(config):
+    """The parts of a training config that a resumed run must share with the interrupted one.
+
+    Normalized through JSON, so that it compares equal after a round trip through a checkpoint.
+    """
+    resume_config = {
+        "run": {"model": config["model"], "dataset": config["dataset"]},
+        "general_config": {
+            key: value for key, value in config["general_config"].items() if key not in RESUME_IGNORED_OPTIONS},
+        "hyperparameters": config["hyperparameters"],
+        "model_config": config["model_config"],
+    }
+    return json.loads(json.dumps(resume_config, default=str))
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def copy_state(src, dst=None, device=None):
+    """Copy a (nested) state dict into the tensors of `dst` in place where possible."""
+    if isinstance(src, torch.Tensor):
+        target_device = src.device if device is None else torch.device(device)
+        if (isinstance(dst, torch.Tensor) and dst.shape == src.shape
+                and dst.dtype == src.dtype and dst.device == target_device):
+            return dst.copy_(src)
+        return src.detach().to(target_device, copy=True)
+    if isinstance(src, dict):
+        dst = dst if isinstance(dst, dict) else {}
+        out = type(src)((key, copy_state(value, dst.get(key), device)) for key, value in src.items())
+        if hasattr(src, "_metadata"):
+            # Module versions used by load_state_dict.
+            out._metadata = src._metadata
+        return out
+    if isinstance(src, (list, tuple)):
+        dst = dst if isinstance(dst, (list, tuple)) and len(dst) == len(src) else [None] * len(src)
+        return type(src)(copy_state(value, d, device) for value, d in zip(src, dst))
+    return src
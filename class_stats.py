@@ -0,0 +1,56 @@
+import os
+import json
+
+import torch
+
+from loguru import logger
+
+
+def compute_class_stats(y, mask=None, num_classes=None, beta=0.999):
+    """Class statistics of the training labels in one vectorized pass.
+
+    `y` holds multi-label indicators (nodes x classes) or class indices, and
+    `mask` selects the training nodes. Returns per-class lists of the positive
+    counts, the priors, the negative-to-positive ratios used as `pos_weight` of
+    the weighted BCE and the effective-number weights (1 - beta) / (1 - beta^n)
+    of Cui et al. (2019), normalized to a mean of 1.
+    """
+    if mask is not None:
+        y = y[mask]
+    num_nodes = y.shape[0]
+    if y.dim() > 1:
+        pos_count = y.sum(dim=0, dtype=torch.float64)
+    else:
+        pos_count = torch.bincount(y.long(), minlength=num_classes or 0).double()
+    neg_count = num_nodes - pos_count
+
+    # Classes without positives get the weight of a single positive.
+    effective_num = (1 - beta ** pos_count.clamp(min=1)) / (1 - beta)
+    effective_weight = 1 / effective_num
+    effective_weight = effective_weight * len(effective_weight) / effective_weight.sum()
+
+    return {
+        "num_nodes": num_nodes,
+        "pos_count": pos_count.tolist(),
+        "prior": (pos_count / max(num_nodes, 1)).tolist(),
+        "pos_weight": (neg_count / pos_count).tolist(),
+        "effective_num_weight": effective_weight.tolist(),
+        "beta": beta,
+    }
+
+
+def get_class_stats(y, mask=None, num_classes=None, save_path=None):
+    """Class statistics of the training labels, cached at `save_path` if given."""
+    if save_path is not None and os.path.exists(save_path):
+        with open(save_path) as in_file:
+            return json.load(in_file)
+
+    stats = compute_class_stats(y, mask, num_classes)
+    if save_path is not None:
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        tmp_path = f"{save_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as out_file:
+            json.dump(stats, out_file)
+        os.replace(tmp_path, save_path)
+        logger.info(f"Class statistics of the training labels are cached at {save_path}")
+    return stats
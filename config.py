@@ -29,18 +29,86 @@ class config:
         # Used if sampling_strategy is SAGE; Must be choosen from SAGE_inductive_options
         "SAGE_inductive_option": "strict",
 
+        # Used if sampling_strategy is SAINT; SAINT_sampler must be choosen from SAINT_sampler_options.
+        # batch_size is the number of sampled nodes (node), edges (edge) or random walk roots (rw) per subgraph.
+        "SAINT_sampler": "rw",
+        "SAINT_walk_length": 2,
+        "SAINT_num_steps": 5, # Number of subgraphs per epoch
+        "SAINT_sample_coverage": 100, # Number of samples per node for the normalization coefficients
+
+        # Used if sampling_strategy is Cluster. The training graph is partitioned once into Cluster_num_parts clusters,
+        # and each batch is the subgraph induced by Cluster_parts_per_batch random clusters.
+        "Cluster_num_parts": 1500,
+        "Cluster_parts_per_batch": 20,
+
         # Enable to use sampling strategy when predicting (val, test, inference). Default: False.
         "sample_when_predict": False,
 
+        # Compute unsampled predictions (val, test, inference) layer by layer over the full graph instead of per seed batch.
+        # Only used if sample_when_predict is False.
+        "layerwise_inference": True,
+        # Incremental inference (pyg.incremental) rebuilds its adjacency once the appended edges outnumber
+        # incremental_compact_ratio times the edges it was built from.
+        "incremental_compact_ratio": 0.1,
+        # Cache the per-layer embeddings of a registered model version on a dataset under
+        # <data cache>-embeddings, memory-mapped and shared by evaluation, inference and incremental inference.
+        # Used with layerwise_inference and data_cache.
+        "embedding_cache": True,
+
+        # Cache the preprocessed splits (normalized features, split graphs) under cache_dir.
+        # Features are memory-mapped when loaded from the cache.
+        "data_cache": True,
+        "cache_dir": "dataset/cache",
+        # Storage precision of the cached features: fp32 or bf16 (half the memory and bandwidth).
+        "cache_feature_precision": "fp32",
+
         "seed": 118010142,
         "device": "cpu",
+        # Compute precision of the forward passes (training, evaluation and inference): fp32 or bf16 (autocast).
+        "precision": "fp32",
+        # Run the forward passes of the training, evaluation and inference steps through torch.compile (inductor),
+        # with dynamic shapes for the varying batch sizes. Falls back to eager mode if compilation fails.
+        "compile": False,
+        # Number of CPU processes for data-parallel training (torch.distributed, gloo). Each process trains on a
+        # disjoint shard of the training seed nodes and gradients are averaged with allreduce. Only the main
+        # process validates, tests and logs to MLflow.
+        "nprocs": 1,
         "tqdm": False,
         "save_model": True,
+        # The best model and optimizer states and the last training state are written to checkpoint_dir/<run_id>
+        # in the background, at most once every checkpoint_debounce seconds. The latest checkpoint_keep best
+        # checkpoints are kept. An interrupted run can be continued with `train ... --resume <run_id>`.
+        "checkpoint_dir": "logs/checkpoints",
+        "checkpoint_debounce": 30,
+        "checkpoint_keep": 2,
         "criterion": "loss",
         "num_epochs": 1000,
         "patience": 100,
+
+        # When to evaluate the test split: "always" (every epoch), "on_improve" (when validation improves)
+        # or "end" (once on the best weights after training). Additionally every test_eval_every epochs if not None.
+        "test_eval_mode": "on_improve",
+        "test_eval_every": None,
         "num_workers": 2,
-        "persistent_workers": True
+        "persistent_workers": True,
+        # One pool of num_workers sampler processes shared by the train, val and test loaders of node-wise
+        # sampling (SAGE, None) instead of a pool per loader. Validation batches are sampled ahead during training.
+        "shared_loader_workers": True,
+        # Batches staged ahead of the compute by a background thread (masks, dtype conversion, pinning and
+        # non-blocking copies to the device). 0 stages them synchronously.
+        "prefetch_batches": 2,
+        # Features of the feature_cache_size highest-degree nodes (hubs of power-law graphs, sampled into most
+        # batches) are kept in a contiguous buffer, the others are gathered from the feature store. None disables.
+        "feature_cache_size": None,
+        # Sample presample_epochs epochs of training batches (SAGE, None) once with a fixed seed into presample_dir
+        # and replay them cyclically, e.g. for sweeps that only change the model. None samples every epoch.
+        "presample_epochs": None,
+        "presample_dir": "dataset/presampled",
+
+        # Log metrics and params from a background thread with batched requests. Records that cannot reach
+        # the tracking server are spooled under mlflow_spool_dir and replayed when it is reachable again.
+        "async_logging": True,
+        "mlflow_spool_dir": "logs/mlflow_spool"
     }
 
     # Hyperparameters
@@ -65,7 +133,9 @@ class config:
             -  soft:
                 Training nodes are cut off from validation nodes and testing nodes to form a training subgraph. However, when doing inference on the validation nodes and testing nodes, the edges  <Node_train, Node_val/Node_test>  and <Node_val, Node_test> can be used.
         - If sampling_strategy is "SAINT"
-            TODO
+            Subgraphs of the training graph are sampled by nodes, edges or random walks (SAINT_sampler), and the training loss is reweighted with GraphSAINT's normalization coefficients. The train/val/test splits follow the SAGE options. Validation and testing use node-wise neighborhoods as for "SAGE".
+        - If sampling_strategy is "Cluster"
+            Cluster-GCN. The training graph is partitioned (METIS if available) and each training batch is the subgraph induced by several clusters, so the cost per step is bounded. The partition is persisted under cache_dir. Validation and testing use node-wise neighborhoods as for "SAGE".
         - If sampling_strategy is "None". string("None")!!!
             This should only happen when the framework is transductive. All neighbors will be used, so the model behaves like GCN. 
         - If sampling_strategy is "GraphBatching":
@@ -78,9 +148,17 @@ class config:
     sampling_strategy_options = [
         "SAGE",  # use the inductive learning proposed by GraphSAGE
         "SAINT",  # use the inductive learning proposed by GraphSAINT
+        "Cluster",  # use the partitioned training proposed by Cluster-GCN
         "GraphBatching", # use for inductive learning with full graph
         "None", # only useful when GCN-like behaviors are desired.
     ]
+    precision_options = ["fp32", "bf16"]
+    test_eval_mode_options = ["always", "on_improve", "end"]
+    SAINT_sampler_options = [
+        "node",
+        "edge",
+        "rw",
+    ]
     SAGE_inductive_options = [
         "default",
         "strict",
@@ -218,8 +296,25 @@ class config:
         #     "jk": "cat"
         # },
                 
+        # GIN with the settings of GIN-benchmark-trans-DGL in config_dgl.py.
         "GIN": {
-
+            "base_model": "GIN_PyG",
+            "overwrite": {
+                "framework": "transductive",
+                "sampling_strategy": "None",
+                "lr" : 5e-3,
+                "weight_decay": 5e-4,
+            },
+            "hidden_node_channels": 64,
+            "num_layers": 5,
+            "num_lin_layers": 2,
+            "eps": 0,
+            "train_eps": False,
+            "dropout": 0.6,
+            "mlp_dropout": 0.3,
+            "mlp_bias": True,
+            # Sum aggregation as a sparse (CSR) matrix product instead of a scatter over the edges.
+            "sparse_aggr": True,
         }
     }
 
@@ -29,18 +29,61 @@ class config:
         # Used if sampling_strategy is SAGE; Must be choosen from SAGE_inductive_options
         "SAGE_inductive_option": "strict",
 
+        # Used if sampling_strategy is SAINT; SAINT_sampler must be choosen from SAINT_sampler_options.
+        # batch_size is the number of sampled nodes (node), edges (edge) or random walk roots (rw) per subgraph.
+        "SAINT_sampler": "rw",
+        "SAINT_walk_length": 2,
+        "SAINT_num_steps": 5, # Number of subgraphs per epoch
+        "SAINT_sample_coverage": 100, # Number of samples per node for the normalization coefficients
+
+        # Used if sampling_strategy is Cluster. The training graph is partitioned once into Cluster_num_parts clusters,
+        # and each batch is the subgraph induced by Cluster_parts_per_batch random clusters.
+        "Cluster_num_parts": 1500,
+        "Cluster_parts_per_batch": 20,
+
         # Enable to use sampling strategy when predicting (val, test, inference). Default: False.
         "sample_when_predict": False,
 
+        # Compute unsampled predictions (val, test) layer by layer over the full graph instead of per seed batch,
+        # for models with layer-wise inference (GIN). Only used if sample_when_predict is False.
+        "layerwise_inference": True,
+
+        # Directory for cached preprocessing results, e.g., GraphSAINT normalization coefficients.
+        "cache_dir": "dataset/cache",
+
         "seed": 118010142,
         "device": "cpu",
+        # Compute precision of the forward passes (training, evaluation and inference): fp32 or bf16 (autocast).
+        "precision": "fp32",
+        # Run the forward passes of the training, evaluation and inference steps through torch.compile (inductor),
+        # with dynamic shapes for the varying batch sizes. Falls back to eager mode if compilation fails.
+        "compile": False,
         "tqdm": False,
         "save_model": True,
+        # The best model and optimizer states and the last training state are written to checkpoint_dir/<run_id>
+        # in the background, at most once every checkpoint_debounce seconds. The latest checkpoint_keep best
+        # checkpoints are kept. An interrupted run can be continued with `train ... --resume <run_id>`.
+        "checkpoint_dir": "logs/checkpoints",
+        "checkpoint_debounce": 30,
+        "checkpoint_keep": 2,
         "criterion": "loss",
         "num_epochs": 1000,
         "patience": 100,
+
+        # When to evaluate the test split: "always" (every epoch), "on_improve" (when validation improves)
+        # or "end" (once on the best weights after training). Additionally every test_eval_every epochs if not None.
+        "test_eval_mode": "on_improve",
+        "test_eval_every": None,
         "num_workers": 2,
-        "persistent_workers": True
+        "persistent_workers": True,
+        # Features of the feature_cache_size highest-degree nodes (hubs of power-law graphs, sampled into most
+        # batches) are kept in a contiguous buffer, the others are gathered from the feature store. None disables.
+        "feature_cache_size": None,
+
+        # Log metrics and params from a background thread with batched requests. Records that cannot reach
+        # the tracking server are spooled under mlflow_spool_dir and replayed when it is reachable again.
+        "async_logging": True,
+        "mlflow_spool_dir": "logs/mlflow_spool"
     }
 
     # Hyperparameters
@@ -65,7 +108,9 @@ class config:
             -  soft:
                 Training nodes are cut off from validation nodes and testing nodes to form a training subgraph. However, when doing inference on the validation nodes and testing nodes, the edges  <Node_train, Node_val/Node_test>  and <Node_val, Node_test> can be used.
         - If sampling_strategy is "SAINT"
-            TODO
+            Subgraphs of the training graph are sampled by nodes, edges or random walks (SAINT_sampler), and the training loss is reweighted with GraphSAINT's normalization coefficients. The train/val/test splits follow the SAGE options. Validation and testing use node-wise neighborhoods as for "SAGE".
+        - If sampling_strategy is "Cluster"
+            Cluster-GCN. The training graph is partitioned (METIS if available) and each training batch is the subgraph induced by several clusters, so the cost per step is bounded. The partition is persisted under cache_dir. Validation and testing use node-wise neighborhoods as for "SAGE".
         - If sampling_strategy is "None". string("None")!!!
             This should only happen when the framework is transductive. All neighbors will be used, so the model behaves like GCN. 
         - If sampling_strategy is "GraphBatching":
@@ -78,9 +123,17 @@ class config:
     sampling_strategy_options = [
         "SAGE",  # use the inductive learning proposed by GraphSAGE
         "SAINT",  # use the inductive learning proposed by GraphSAINT
+        "Cluster",  # use the partitioned training proposed by Cluster-GCN
         "None", # only useful when GCN-like behaviors are desired.
         "GraphBatching",
     ]
+    precision_options = ["fp32", "bf16"]
+    test_eval_mode_options = ["always", "on_improve", "end"]
+    SAINT_sampler_options = [
+        "node",
+        "edge",
+        "rw",
+    ]
     SAGE_inductive_options = [
         "default",
         "strict",
@@ -195,7 +248,7 @@ class config:
                 "weight_decay": 5e-4,
             },
             "hidden_node_channels": 64,
-            "num_gcn_layers": 5,
+            "num_layers": 5,
             "num_lin_layers": 2,
             "aggregator_type": 'sum',
             "init_eps": 0,
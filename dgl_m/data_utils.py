@@ -1,13 +1,18 @@
+import os
 import torch
 import dgl.transforms as T
 
 import dgl
-from dgl.dataloading import NeighborSampler, DataLoader, GraphDataLoader
+from dgl.dataloading import NeighborSampler, MultiLayerFullNeighborSampler, SAINTSampler, ClusterGCNSampler, DataLoader, GraphDataLoader, Sampler
 from dgl import DGLGraph
 from torch.utils.data import Dataset
 
 from loguru import logger
 
+from class_stats import get_class_stats
+from feature_cache import FeatureCache
+from .train_utils import get_general_option
+
 
 
 def get_data_SAGE(config):
@@ -72,8 +77,8 @@ def get_data_SAGE(config):
 
 
 def get_data_SAINT(config):
-    dataset_config = config["dataset_config"]
-    logger.exception('Not Implemented.')
+    # GraphSAINT samples subgraphs of the training graph, so the splits are the same as for SAGE.
+    return get_data_SAGE(config)
     
 
 def get_data_graph_batch(config):
@@ -86,63 +91,294 @@ def get_data_graph_batch(config):
         
     return train_dataset, val_dataset, test_dataset
 
-def get_loader_SAGE(train_data, val_data, test_data, config):
-    model_config = config["model_config"]
-    num_neighbors = model_config.get("num_neighbors", -1)
-    if isinstance(num_neighbors, int):
-        num_neighbors = [num_neighbors] * model_config["num_layers"]
-    elif isinstance(num_neighbors, list):
-        num_neighbors = num_neighbors
-        assert len(num_neighbors) == model_config["num_layers"]
+class FeatureCacheSampler(Sampler):
+    """Block sampler gathering the input features of the blocks through a FeatureCache.
 
-    params = config["hyperparameters"]
-    
-    general_config = config["general_config"]
+    The graph given to the loader is a copy of the full graph without the
+    "feat" node data, so that only the cache gathers features.
+    """
 
-    logger.info(
-        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+    def __init__(self, sampler, feature_cache: FeatureCache):
+        super().__init__()
+        self.sampler = sampler
+        self.feature_cache = feature_cache
 
-    neighborsampler = NeighborSampler(num_neighbors)
+    def sample(self, g, seed_nodes, exclude_eids=None):
+        input_nodes, output_nodes, blocks = self.sampler.sample(g, seed_nodes, exclude_eids)
+        blocks[0].srcdata['feat'] = self.feature_cache[input_nodes]
+        return input_nodes, output_nodes, blocks
 
-    train_loader = DataLoader(
-        graph=train_data,
-        indices=train_data.nodes()[train_data.ndata['train_mask']],
-        graph_sampler=neighborsampler,
-        batch_size=params["batch_size"],
+
+def get_node_loader(graph: DGLGraph, graph_sampler, caches: dict, feature_cache_size=None, **kwargs):
+    """Node DataLoader of `graph`, gathering the input features through its FeatureCache if `feature_cache_size`.
+
+    The cache of the `feature_cache_size` most connected nodes is shared by the
+    loaders of the graph through `caches`.
+    """
+    if not feature_cache_size:
+        return DataLoader(graph=graph, graph_sampler=graph_sampler, **kwargs)
+    if id(graph) not in caches:
+        topology = graph.local_var()
+        del topology.ndata['feat']
+        # Sampled as a source node, i.e. as a neighbor of the seed nodes.
+        caches[id(graph)] = (topology, FeatureCache(graph.ndata['feat'], graph.out_degrees(), feature_cache_size))
+    topology, feature_cache = caches[id(graph)]
+    return DataLoader(graph=topology, graph_sampler=FeatureCacheSampler(graph_sampler, feature_cache), **kwargs)
+
+
+def get_node_features(loader):
+    """Input features of all nodes of a node loader's graph, including those served by its FeatureCache."""
+    feature_cache = getattr(loader.graph_sampler, "feature_cache", None)
+    if feature_cache is not None:
+        return feature_cache.x
+    return loader.graph.ndata['feat']
+
+
+def get_seed_nodes(loader, split):
+    """Nodes predicted for the given split of a node-level loader."""
+    if isinstance(loader.graph_sampler, (NeighborSampler, FeatureCacheSampler)):
+        return loader.indices
+    return loader.graph.nodes()[loader.graph.ndata[f'{split}_mask']]
+
+
+def get_layerwise_loader(graph: DGLGraph, config):
+    """Loader over the full 1-hop neighborhoods of all nodes of `graph`, for layer-wise inference.
+
+    Yields single blocks; the node embeddings of each layer are gathered by
+    `dgl_m.inference.layerwise_inference` itself.
+    """
+    general_config = config["general_config"]
+    topology = graph.local_var()
+    for key in list(topology.ndata.keys()):
+        del topology.ndata[key]
+    return DataLoader(
+        graph=topology,
+        indices=topology.nodes(),
+        graph_sampler=MultiLayerFullNeighborSampler(1),
+        batch_size=config["hyperparameters"]["batch_size"],
         num_workers=general_config["num_workers"],
-        persistent_workers=general_config["persistent_workers"]
+        persistent_workers=general_config["persistent_workers"],
     )
 
-    if not general_config["sample_when_predict"]:
+
+def get_num_neighbors(config, predict=False):
+    """Number of neighbors sampled per layer, or all of them when predicting without sample_when_predict."""
+    model_config = config["model_config"]
+    if predict and not config["general_config"]["sample_when_predict"]:
         logger.warning(
             "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
-        num_neighbors = [-1] * model_config["num_layers"]
-        neighborsampler = NeighborSampler(num_neighbors)
+        return [-1] * model_config["num_layers"]
+
+    num_neighbors = model_config.get("num_neighbors", -1)
+    if isinstance(num_neighbors, int):
+        return [num_neighbors] * model_config["num_layers"]
+    assert len(num_neighbors) == model_config["num_layers"]
+    return list(num_neighbors)
+
 
-    val_loader = DataLoader(
+def get_predict_loaders(val_data, test_data, config, caches=None):
+    """Validation and test loaders on full (or sampled) node-wise neighborhoods.
+
+    Used by every node-wise strategy (SAGE, SAINT, Cluster). `caches` shares
+    the feature caches with the training loader.
+    """
+    params = config["hyperparameters"]
+    general_config = config["general_config"]
+    neighborsampler = NeighborSampler(get_num_neighbors(config, predict=True))
+
+    caches = {} if caches is None else caches
+    val_loader = get_node_loader(
         graph=val_data,
         indices=val_data.nodes()[val_data.ndata['val_mask']],
         graph_sampler=neighborsampler,
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    test_loader = DataLoader(
+    test_loader = get_node_loader(
         graph=test_data,
         indices=test_data.nodes()[test_data.ndata['test_mask']],
         graph_sampler=neighborsampler,
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
+
+    return val_loader, test_loader
+
+
+def get_loader_SAGE(train_data, val_data, test_data, config):
+    params = config["hyperparameters"]
     
+    general_config = config["general_config"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    caches = {}
+    train_loader = get_node_loader(
+        graph=train_data,
+        indices=train_data.nodes()[train_data.ndata['train_mask']],
+        graph_sampler=NeighborSampler(get_num_neighbors(config)),
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
+        batch_size=params["batch_size"],
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"]
+    )
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config, caches)
 
     return train_loader, val_loader, test_loader
 
 
-def get_loader_SAINT(data: DGLGraph, config):
-    logger.exception("Not implemented.")
+def get_SAINT_sampler(config):
+    general_config = config["general_config"]
+    batch_size = config["hyperparameters"]["batch_size"]
+    match general_config["SAINT_sampler"]:
+        case "node":
+            return SAINTSampler(mode="node", budget=batch_size)
+        case "edge":
+            return SAINTSampler(mode="edge", budget=batch_size)
+        case "rw":
+            return SAINTSampler(mode="walk", budget=(batch_size, general_config["SAINT_walk_length"]))
+        case _:
+            raise ValueError(f"Unrecognized SAINT sampler: {general_config['SAINT_sampler']}")
+
+
+def get_SAINT_norm_path(config):
+    """File caching the GraphSAINT normalization coefficients.
+
+    The coefficients depend on the training graph and on the sampler settings.
+    """
+    general_config = config["general_config"]
+    name = "-".join([
+        config["dataset"],
+        general_config["framework"],
+        general_config["SAGE_inductive_option"],
+        "SAINT",
+        general_config["SAINT_sampler"],
+        f"b{config['hyperparameters']['batch_size']}",
+        f"w{general_config['SAINT_walk_length']}",
+        f"c{general_config['SAINT_sample_coverage']}",
+    ])
+    return os.path.join(general_config.get("cache_dir", "dataset/cache"), "dgl", name + ".pt")
+
+
+def compute_SAINT_node_norm(graph: DGLGraph, sampler, num_steps, sample_coverage, save_path):
+    """GraphSAINT node normalization coefficients, estimated as in PyG.
+
+    Subgraphs are sampled until every node is covered `sample_coverage` times on
+    average. The coefficients are cached at `save_path`.
+    """
+    if os.path.exists(save_path):
+        return torch.load(save_path)
+
+    num_nodes = graph.num_nodes()
+    node_count = torch.zeros(num_nodes)
+    num_samples = total_sampled_nodes = 0
+    while total_sampled_nodes < num_nodes * sample_coverage:
+        for i in range(num_steps):
+            node_ids = sampler.sample(graph, i).ndata[dgl.NID]
+            node_count[node_ids] += 1
+            total_sampled_nodes += node_ids.shape[0]
+        num_samples += num_steps
+
+    node_count[node_count == 0] = 0.1
+    node_norm = num_samples / node_count / num_nodes
+
+    if not os.path.exists(os.path.dirname(save_path)):
+        os.makedirs(os.path.dirname(save_path))
+    torch.save(node_norm, save_path)
+    return node_norm
+
+
+def get_train_class_stats(train_loader, config):
+    """Class statistics of the training labels, read from the graph of the loader instead of its batches."""
+    if hasattr(train_loader, "graph"):
+        y, mask = train_loader.graph.ndata['label'], train_loader.graph.ndata['train_mask']
+    else:
+        # Graph batching: every node of the training graphs.
+        y, mask = torch.cat([graph.ndata['label'] for graph in train_loader.dataset]), None
+    general_config = config["general_config"]
+    name = "-".join([config["dataset"], general_config["framework"], general_config["SAGE_inductive_option"], "class_stats"])
+    save_path = os.path.join(general_config.get("cache_dir", "dataset/cache"), "dgl", name + ".json")
+    return get_class_stats(y, mask, config["dataset_config"]["num_classes"], save_path=save_path)
+
+
+def get_loader_SAINT(train_data, val_data, test_data, config):
+    general_config = config["general_config"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    saint_sampler = get_SAINT_sampler(config)
+    if general_config["SAINT_sample_coverage"] > 0:
+        train_data.ndata['saint_norm'] = compute_SAINT_node_norm(
+            train_data,
+            saint_sampler,
+            general_config["SAINT_num_steps"],
+            general_config["SAINT_sample_coverage"],
+            get_SAINT_norm_path(config),
+        )
+
+    # Each index yields one sampled subgraph.
+    train_loader = DataLoader(
+        graph=train_data,
+        indices=torch.arange(general_config["SAINT_num_steps"]),
+        graph_sampler=saint_sampler,
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config)
+
+    return train_loader, val_loader, test_loader
+
+
+def get_data_Cluster(config):
+    # Clusters partition the training graph, so the splits are the same as for SAGE.
+    return get_data_SAGE(config)
+
+
+def get_loader_Cluster(train_data, val_data, test_data, config):
+    general_config = config["general_config"]
+    num_parts = general_config["Cluster_num_parts"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    # The METIS partition is computed once and persisted at cache_path.
+    name = "-".join([
+        config["dataset"],
+        general_config["framework"],
+        general_config["SAGE_inductive_option"],
+        "Cluster",
+        f"p{num_parts}",
+    ])
+    cache_path = os.path.join(general_config.get("cache_dir", "dataset/cache"), "dgl", name + ".pkl")
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+
+    # Each batch is the subgraph induced by several random clusters.
+    train_loader = DataLoader(
+        graph=train_data,
+        indices=torch.arange(num_parts),
+        graph_sampler=ClusterGCNSampler(train_data, num_parts, cache_path=cache_path),
+        batch_size=general_config["Cluster_parts_per_batch"],
+        shuffle=True,
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config)
+
+    return train_loader, val_loader, test_loader
 
 
 def get_loader_no_sampling(train_data, val_data, test_data, config):
@@ -159,28 +395,35 @@ def get_loader_no_sampling(train_data, val_data, test_data, config):
 
     neighborsampler = NeighborSampler(num_neighbors)
 
-    train_loader = DataLoader(
+    caches = {}
+    train_loader = get_node_loader(
         graph=train_data,
         indices=train_data.nodes()[train_data.ndata['train_mask']],
         graph_sampler=neighborsampler,
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=config['hyperparameters']['batch_size'],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    val_loader = DataLoader(
+    val_loader = get_node_loader(
         graph=val_data,
         indices=val_data.nodes()[val_data.ndata['val_mask']],
         graph_sampler=neighborsampler,
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=config['hyperparameters']['batch_size'],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    test_loader = DataLoader(
+    test_loader = get_node_loader(
         graph=test_data,
         indices=test_data.nodes()[test_data.ndata['test_mask']],
         graph_sampler=neighborsampler,
+        caches=caches,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=config['hyperparameters']['batch_size'],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
@@ -221,16 +464,35 @@ def get_data(config):
         return get_data_SAINT(config)
 
 
+def share_graphs(graphs, config):
+    """Prepare the graphs of the splits once for the workers of all loaders.
+
+    The sparse formats used for sampling are materialized in the main process
+    and the node and edge features are moved to shared memory, so that loader
+    workers map one copy instead of each building their own. Splits sharing
+    one graph (transductive) are prepared once.
+    """
+    if config["general_config"]["num_workers"] > 0:
+        for graph in {id(graph): graph for graph in graphs}.values():
+            graph.create_formats_()
+            for frame in [graph.ndata, graph.edata]:
+                for value in frame.values():
+                    value.share_memory_()
+    return graphs
+
+
 def get_loader(config):
     sampling_strategy = config["general_config"]["sampling_strategy"]
     if sampling_strategy == 'SAGE':
-        return get_loader_SAGE(*get_data_SAGE(config), config)
+        return get_loader_SAGE(*share_graphs(get_data_SAGE(config), config), config)
     elif sampling_strategy == 'SAINT':
-        return get_loader_SAINT(*get_data_SAINT(config), config)
+        return get_loader_SAINT(*share_graphs(get_data_SAINT(config), config), config)
+    elif sampling_strategy == 'Cluster':
+        return get_loader_Cluster(*share_graphs(get_data_Cluster(config), config), config)
     elif sampling_strategy == 'GraphBatching':
         return get_loader_graph_batch(*get_data_graph_batch(config), config)
     elif sampling_strategy == 'None' or sampling_strategy == None:
-        return get_loader_no_sampling(*get_data_SAGE(config), config)
+        return get_loader_no_sampling(*share_graphs(get_data_SAGE(config), config), config)
     
 
 def get_inference_data_SAGE(config):
@@ -269,20 +531,12 @@ def get_inference_data_SAGE(config):
             return unlabelled_data
         
 def get_inference_data_SAINT(config):
-    pass
+    return get_inference_data_SAGE(config)
 
 def get_inference_data_graph_batch(config):
     pass
 
 def get_inference_loader_SAGE(infer_data:DGLGraph, config:dict):
-    model_config = config["model_config"]
-    num_neighbors = model_config.get("num_neighbors", -1)
-    if isinstance(num_neighbors, int):
-        num_neighbors = [num_neighbors] * model_config["num_layers"]
-    elif isinstance(num_neighbors, list):
-        num_neighbors = num_neighbors
-        assert len(num_neighbors) == model_config["num_layers"]
-
     params = config["hyperparameters"]
     
     general_config = config["general_config"]
@@ -290,18 +544,14 @@ def get_inference_loader_SAGE(infer_data:DGLGraph, config:dict):
     logger.info(
         f"\ninference_data={infer_data}")
 
-    if not general_config["sample_when_predict"]:
-        logger.warning(
-            "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
-        num_neighbors = [-1] * model_config["num_layers"]
-
+    neighborsampler = NeighborSampler(get_num_neighbors(config, predict=True))
 
-    neighborsampler = NeighborSampler(num_neighbors)
-
-    infer_loader = DataLoader(
+    infer_loader = get_node_loader(
         graph=infer_data,
         indices=infer_data.nodes()[infer_data.ndata['infer_mask']],
         graph_sampler=neighborsampler,
+        caches={},
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"]
@@ -309,8 +559,9 @@ def get_inference_loader_SAGE(infer_data:DGLGraph, config:dict):
 
     return infer_data, infer_loader
 
-def get_inference_loader_SAINT(data:DGLGraph, config:dict):
-    pass
+def get_inference_loader_SAINT(infer_data:DGLGraph, config:dict):
+    # GraphSAINT is a training sampler; prediction uses node-wise neighborhoods.
+    return get_inference_loader_SAGE(infer_data, config)
 
 def get_inference_loader_no_sampling(infer_data: DGLGraph, config:dict):
     model_config = config["model_config"]
@@ -328,10 +579,12 @@ def get_inference_loader_no_sampling(infer_data: DGLGraph, config:dict):
 
     neighborsampler = NeighborSampler(num_neighbors)
 
-    infer_loader = DataLoader(
+    infer_loader = get_node_loader(
         graph=infer_data,
         indices=infer_data.nodes()[infer_data.ndata['infer_mask']],
         graph_sampler=neighborsampler,
+        caches={},
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=infer_data.num_nodes(),
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
@@ -350,6 +603,9 @@ def get_inference_loader(config):
         return get_inference_loader_SAGE(get_inference_data_SAGE(config), config)
     elif sampling_strategy == 'SAINT':
         return get_inference_loader_SAINT(get_inference_data_SAINT(config), config)
+    elif sampling_strategy == 'Cluster':
+        # Cluster-GCN is a training strategy; prediction uses node-wise neighborhoods.
+        return get_inference_loader_SAGE(get_inference_data_SAGE(config), config)
     elif sampling_strategy == 'GraphBatching':
         return get_inference_loader_graph_batch(get_inference_data_graph_batch(config), config)
     elif sampling_strategy == 'None' or sampling_strategy == None:
@@ -1,50 +1,76 @@
 import torch
 import os
 
-import numpy as np
-import pandas as pd
-
-from .data_utils import get_inference_loader
+from .data_utils import get_inference_loader, get_layerwise_loader, get_node_features
+from .train_utils import use_layerwise_inference, get_autocast, get_general_option
 
 from mlflow import MlflowClient
 from mlflow.pytorch import load_model as load_pyt_model
 
+from compile_utils import compile_model
+from prediction_writer import PredictionWriter, get_prediction_path
+
 from loguru import logger
 from tqdm import tqdm
 
 
-def inference(model, loader, enable_tqdm, sampling_strategy, device="cpu", multilabel=False, threshold=0):
-    n_ids = []
-    predictions = []
+@torch.no_grad()
+def layerwise_inference(model, x, loader, enable_tqdm=False, device="cpu", precision="fp32"):
+    """Compute the outputs of all nodes one layer at a time from their input features `x`.
+
+    `loader` yields the full 1-hop neighborhoods of all nodes (see
+    `get_layerwise_loader`), so every layer touches each edge exactly once
+    instead of re-expanding the k-hop neighborhood of every seed batch.
+    """
+    model.eval()
+    x_all = x
+    for i in range(model.num_layers):
+        x_next = None
+        bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
+        bar.set_description(f"layer {i+1}/{model.num_layers}")
+        for input_nodes, output_nodes, blocks in bar:
+            h = x_all[input_nodes].to(device)
+            with get_autocast(device, precision):
+                out = model.layer_forward(i, blocks[0].to(device), h if precision == "bf16" else h.float())
+            if x_next is None:
+                x_next = torch.empty((x_all.shape[0], out.shape[-1]), dtype=out.dtype)
+            x_next[output_nodes] = out.cpu()
+        x_all = x_next
+    return x_all.float()
+
+
+def inference(model, loader, writer, enable_tqdm, sampling_strategy, device="cpu", multilabel=False, threshold=0, precision="fp32", write_probs=False, labels=None):
+    """Predict the seed nodes of `loader` and stream them to the PredictionWriter `writer`.
+
+    Every batch is written as soon as it is predicted (with the probabilities
+    if `write_probs`, and the truths from `labels` if given), so no
+    predictions are gathered in memory.
+    """
+    model.eval()
     bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
 
-    for batch in bar:
-        if sampling_strategy in ["SAGE", None, "None"]:
-            mask = torch.arange(batch.batch_size)
-            batch_n_ids = batch.n_id[mask]
-        elif sampling_strategy in ["GraphBatching"]:
-            mask = torch.ones(batch.x.shape[0], dtype=bool)
+    for input_nodes, output_nodes, mfgs in bar:
+        if sampling_strategy in ["GraphBatching"]:
             raise NotImplementedError
-        
-        outputs = model(batch.x.to(device), batch.edge_index.to(device))[mask]
+        mfgs = [mfg.to(device) for mfg in mfgs]
+
+        with torch.no_grad(), get_autocast(device, precision):
+            outputs = model(mfgs, mfgs[0].srcdata['feat'])
         
         if multilabel:
             preds = outputs > threshold
         else:
             preds = outputs.argmax(dim=-1)
-        
-        n_ids.append(batch_n_ids)
-        predictions.append(preds)
-        
-    # Metrics
-    n_ids = torch.cat(n_ids, dim=0).detach().numpy()
-    predictions = torch.cat(predictions, dim=0).detach().cpu().numpy()
-    
-    idx = np.argsort(n_ids)
-    n_ids = n_ids[idx]
-    predictions = predictions[idx]
-    
-    return n_ids, predictions
+
+        writer.write(
+            output_nodes, preds,
+            probs=get_probabilities(outputs, multilabel) if write_probs else None,
+            truths=labels[output_nodes] if labels is not None else None)
+
+
+def get_probabilities(outputs, multilabel=False):
+    outputs = outputs.float()
+    return torch.sigmoid(outputs) if multilabel else torch.softmax(outputs, dim=-1)
     
 
 def overwrite_model_config(model, config):
@@ -75,48 +101,42 @@ def infer_gnn(config):
     dataset_config = config["dataset_config"]
 
     data, loader = get_inference_loader(config)
+    multilabel = True if dataset_config["task_type"].startswith("multi") else False
+    precision = get_general_option(config, "precision", "fp32")
+    labels = data.ndata['label'] if vargs["write_truths"] and vargs["split"] != "unlabelled" else None
 
-    n_ids, predictions = inference(
-        model,
-        loader,
-        enable_tqdm=vargs["tqdm"],
-        sampling_strategy=general_config["sampling_strategy"],
-        device=general_config["device"],
-        multilabel= True if dataset_config["task_type"].startswith("multi") else False
-        )
-    
-    
-    # Save predictions
-    pred_path = os.path.join(
-        vargs["output_dir"],
-        f"{config['model']}-v{version}-{config['dataset']}",
-        f"{vargs['split']}-pred"
-    )+".csv"
-    
-    save_dir = os.path.split(pred_path)[0]
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-        
-    n = n_ids.shape[0]
-    content = np.hstack((n_ids.reshape(n, -1), predictions.reshape(n, -1)))
-    pred_df = pd.DataFrame(content)
-    col_names = ["n_id"]
-    if predictions.ndim > 1:
-        for i in range(predictions.shape[1]):
-            col_names.append(f"pred_{i+1}")
-    else:
-        col_names.append("pred")
-    print(pred_df)
-    pred_df.columns = col_names
-    pred_df.to_csv(pred_path, index=False)
-    
-    truth_path = os.path.join(save_dir, f"{vargs['split']}-truth.csv")
-    
-    content = np.hstack((n_ids.reshape(n, -1), data.y.numpy()[n_ids].reshape(n, -1)))
-    truth_df = pd.DataFrame(content)
-    truth_df.columns = col_names
-    truth_df.to_csv(truth_path, index=False)
-    
-    
-        
-        
\ No newline at end of file
+    # Predictions are streamed to the output file batch by batch
+    pred_path = get_prediction_path(
+        vargs["output_dir"], f"{config['model']}-v{version}-{config['dataset']}", vargs["split"], vargs["output_format"])
+    with PredictionWriter(pred_path, vargs["output_format"]) as writer:
+        if use_layerwise_inference(config, model):
+            logger.info("Using layer-wise full-graph inference.")
+            outputs = layerwise_inference(
+                model,
+                get_node_features(loader),
+                get_layerwise_loader(data, config),
+                enable_tqdm=vargs["tqdm"],
+                device=general_config["device"],
+                precision=precision,
+            )
+            # Seed nodes come from infer_mask in ascending order.
+            n_ids = data.nodes()[data.ndata['infer_mask']]
+            for chunk in n_ids.split(config["hyperparameters"]["batch_size"]):
+                chunk_outputs = outputs[chunk]
+                writer.write(
+                    chunk, chunk_outputs > 0 if multilabel else chunk_outputs.argmax(dim=-1),
+                    probs=get_probabilities(chunk_outputs, multilabel) if vargs["write_probs"] else None,
+                    truths=labels[chunk] if labels is not None else None)
+        else:
+            inference(
+                compile_model(model, get_general_option(config, "compile", False)),
+                loader,
+                writer,
+                enable_tqdm=vargs["tqdm"],
+                sampling_strategy=general_config["sampling_strategy"],
+                device=general_config["device"],
+                multilabel=multilabel,
+                precision=precision,
+                write_probs=vargs["write_probs"],
+                labels=labels,
+                )
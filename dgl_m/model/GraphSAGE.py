@@ -93,6 +93,10 @@ class GraphSAGE_DGL(nn.Module):
         
 
         # hs: List[Tensor] = []
+
+        # Full graphs (e.g., GraphSAINT subgraphs) are used as the block of every layer.
+        if not isinstance(mfgs, list):
+            mfgs = [mfgs] * self.num_layers
         
         for idx, layer in enumerate(self.convs):
             if idx == 0:
@@ -1,24 +1,29 @@
 import torch
 import mlflow
+import tracking
 import pprint
 import os
-import copy
+import shutil
 
 import numpy as np
 
-from .data_utils import get_loader
-from .train_utils import get_loss_fn, get_model
+from .data_utils import get_loader, get_train_class_stats, get_layerwise_loader, get_node_features, get_seed_nodes
+from .inference import layerwise_inference
+from .train_utils import get_loss_fn, get_model, use_layerwise_inference, get_weighted_loss, should_eval_test, get_autocast
+
+from metrics import MetricAccumulator
+from checkpoint import SnapshotManager, load_last_checkpoint, get_resume_config
+from compile_utils import compile_model, CompiledModel
 
 from loguru import logger
 from tqdm import tqdm
-from sklearn.metrics import classification_report, f1_score
 # from torch_geometric.nn import summary
 
 from mlflow import MlflowClient
 from mlflow.models.signature import ModelSignature
 from mlflow.types.schema import Schema, TensorSpec
 
-def node_classification_step(mode: str, epoch, loader, model, loss_fn, optimizer, enable_tqdm, sampling_strategy, batch_size, device="cpu", multilabel=False, threshold=0):
+def node_classification_step(mode: str, epoch, loader, model, loss_fn, optimizer, enable_tqdm, sampling_strategy, batch_size, num_classes, device="cpu", multilabel=False, threshold=0, node_loss_fn=None, precision="fp32"):
     if mode == "test":
         model.eval()
     else:
@@ -29,15 +34,23 @@ def node_classification_step(mode: str, epoch, loader, model, loss_fn, optimizer
         elif mode == "val":
             model.eval()
 
-    predictions = []
-    truths = []
+    metrics = MetricAccumulator(num_classes, multilabel=multilabel)
     bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
     for graph in bar:
         
         if mode == "train":
             optimizer.zero_grad()
 
-        if sampling_strategy in ["SAGE", None, "None"]:
+        node_weight = None
+        if sampling_strategy in ["SAINT", "Cluster"] and mode == "train":
+            # Subgraph sampling: predict every training node of the sampled subgraph.
+            mask = graph.ndata['train_mask']
+            mfgs = graph
+            targets = graph.ndata['label'][mask]
+            inputs = graph.ndata['feat']
+            if 'saint_norm' in graph.ndata:
+                node_weight = graph.ndata['saint_norm'][mask]
+        elif sampling_strategy in ["SAGE", "SAINT", "Cluster", None, "None"]:
             # mask = torch.arange(batch_size, device=device)
             mfgs = graph[2]
             targets = mfgs[-1].dstdata['label']
@@ -49,18 +62,25 @@ def node_classification_step(mode: str, epoch, loader, model, loss_fn, optimizer
             inputs = mfgs.ndata['feat']
 
         
-        outputs = model(mfgs, inputs)
+        with get_autocast(device, precision):
+            outputs = model(mfgs, inputs)
+        outputs = outputs.float()
+        if sampling_strategy in ["SAINT", "Cluster"] and mode == "train":
+            outputs = outputs[mask]
 
         if multilabel:
             preds = outputs > threshold
         else:
             preds = outputs.argmax(dim=-1)
 
-        predictions.append(preds)
-        truths.append(targets)
+        metrics.update(preds.detach(), targets)
 
         if mode != "test":
-            loss = loss_fn(outputs, targets)
+            if node_weight is not None:
+                # Correct the sampling bias of GraphSAINT subgraphs.
+                loss = get_weighted_loss(node_loss_fn, outputs, targets, node_weight)
+            else:
+                loss = loss_fn(outputs, targets)
             loss.backward()
 
             if mode == "train":
@@ -73,24 +93,57 @@ def node_classification_step(mode: str, epoch, loader, model, loss_fn, optimizer
             bar.set_description(f"{mode}_loss={loss:<8.6g}")
 
     # Metrics
-    predictions = torch.cat(predictions, dim=0).detach().cpu().numpy()
-    truths = torch.cat(truths, dim=0).detach().cpu().numpy()
-
     if mode != "test":
         avg_loss = total_loss/total_num
-        mlflow.log_metric(f"{mode} loss", avg_loss, epoch)
+        tracking.log_metric(f"{mode} loss", avg_loss, epoch)
 
-    f1 = f1_score(truths, predictions, average="micro")
-    mlflow.log_metric(f"{mode} F1", f1, epoch)
+    f1 = metrics.f1("micro")
+    tracking.log_metric(f"{mode} F1", f1, epoch)
 
     if mode == "train":
         return avg_loss, f1
     elif mode == "val":
         return avg_loss, f1
     elif mode == "test":
-        return f1, truths, predictions
+        return f1, metrics
+
+@torch.no_grad()
+def node_classification_layerwise_step(mode: str, epoch, loader, outputs, loss_fn, num_classes, multilabel=False, threshold=0):
+    """Val/test step on the seed nodes of `loader` from precomputed full-graph outputs."""
+    n_ids = get_seed_nodes(loader, mode)
+    targets = loader.graph.ndata['label'][n_ids]
+    outputs = outputs[n_ids]
+
+    if multilabel:
+        preds = outputs > threshold
+    else:
+        preds = outputs.argmax(dim=-1)
+
+    metrics = MetricAccumulator(num_classes, multilabel=multilabel)
+    metrics.update(preds, targets)
+
+    if mode != "test":
+        avg_loss = loss_fn(outputs, targets).item()
+        tracking.log_metric(f"{mode} loss", avg_loss, epoch)
+
+    f1 = metrics.f1("micro")
+    tracking.log_metric(f"{mode} F1", f1, epoch)
+
+    if mode == "val":
+        return avg_loss, f1
+    elif mode == "test":
+        return f1, metrics
+
 
 def train_gnn(config):
+    try:
+        run_training(config)
+    finally:
+        # Records queued before a failure are still sent or spooled, and the logging thread is stopped.
+        tracking.end_async_logging()
+
+
+def run_training(config):
 
     mlflow_config = config["mlflow_config"]
     general_config = config["general_config"]
@@ -104,11 +157,22 @@ def train_gnn(config):
     mlflow.set_experiment(mlflow_config["experiment"])
     run_name = f"{config['model']}-{config['dataset']}"
     model_name = run_name
-    run = mlflow.start_run(run_name=run_name)
-    mlflow.set_tag(
-        "base model", model_config["base_model"])
-    mlflow.set_tag("dataset", config["dataset"])
-    logger.info(f"Launching run: {run.info.run_name}")
+    resume_run_id = config["vargs"].get("resume")
+    if resume_run_id is not None:
+        # Continue an interrupted run from its last checkpoint
+        checkpoint = load_last_checkpoint(os.path.join(general_config["checkpoint_dir"], resume_run_id))
+        run = mlflow.start_run(run_id=resume_run_id)
+        logger.info(f"Resuming run: {run.info.run_name} after epoch {checkpoint['epoch']}")
+    else:
+        run = mlflow.start_run(run_name=run_name)
+        mlflow.set_tag(
+            "base model", model_config["base_model"])
+        mlflow.set_tag("dataset", config["dataset"])
+        mlflow.set_tag("precision", general_config["precision"])
+        logger.info(f"Launching run: {run.info.run_name}")
+    if general_config["async_logging"]:
+        # Metrics and params are sent in batches from a background thread.
+        tracking.start_async_logging(run.info.run_id, spool_dir=general_config["mlflow_spool_dir"])
 
     # Log hyperparameters
     params = config["hyperparameters"]
@@ -117,8 +181,9 @@ def train_gnn(config):
     general_config_str = pprint.pformat(general_config)
     logger.info(f"General configurations:\n{general_config_str}")
     logger.info(f"Hyperparameters:\n{params_str}")
-    mlflow.log_params(general_config)
-    mlflow.log_params(params)
+    if resume_run_id is None:
+        tracking.log_params(general_config)
+        tracking.log_params(params)
 
     # Get loaders
     train_loader, val_loader, test_loader = get_loader(config)
@@ -127,15 +192,15 @@ def train_gnn(config):
     model = get_model(config)
     model.to(device).reset_parameters()
 
-    # Setup loss function
-    loss_fn = get_loss_fn(config, train_loader, reduction='mean')
+    # Setup loss function (class statistics are computed from the labels once and cached with the dataset)
+    class_stats = get_train_class_stats(train_loader, config)
+    loss_fn = get_loss_fn(config, class_stats, reduction='mean')
+    node_loss_fn = None
+    if general_config["sampling_strategy"] == "SAINT":
+        node_loss_fn = get_loss_fn(config, class_stats, reduction='none')
 
-    # Setup save directory for optimizer states
-    if general_config["save_model"]:
-        save_path = os.path.join(
-            "logs/tmp", f"{run.info.run_name}-Optimizer-{run.info.run_id}.tar")
-        if not os.path.exists(os.path.dirname(save_path)):
-            os.makedirs(os.path.dirname(save_path))
+    # Setup save directory for checkpoints
+    save_dir = os.path.join(general_config["checkpoint_dir"], run.info.run_id)
 
     # Summary logging
     # sample_batch = None
@@ -188,6 +253,14 @@ def train_gnn(config):
     optimizer = torch.optim.Adam(
         model.parameters(), lr=params["lr"], weight_decay=params["weight_decay"])
 
+    # Compiled forward passes for the training steps; `model` itself stays eager for snapshots, summary and logging.
+    step_model = compile_model(model, general_config["compile"])
+
+    # Best model snapshots and the last training state, written as checkpoints in the background
+    snapshots = SnapshotManager(model, optimizer, save_dir=save_dir,
+                                debounce=general_config["checkpoint_debounce"], keep=general_config["checkpoint_keep"],
+                                config=get_resume_config(config))
+
     # Setup metrics
     criterion = general_config["criterion"].lower()
     if criterion == "loss":
@@ -203,56 +276,109 @@ def train_gnn(config):
     # Setup training steps according to task type
     sampling_strategy = general_config["sampling_strategy"]
     if dataset_config["task_type"] == "single-label-NC":
-        run_step = lambda *args, **kwargs: node_classification_step(*args, model=model, batch_size=params['batch_size'], loss_fn=loss_fn, optimizer=optimizer, enable_tqdm=general_config["tqdm"], sampling_strategy=sampling_strategy, device=device, **kwargs)
+        run_step = lambda *args, **kwargs: node_classification_step(*args, model=step_model, batch_size=params['batch_size'], loss_fn=loss_fn, optimizer=optimizer, enable_tqdm=general_config["tqdm"], sampling_strategy=sampling_strategy, num_classes=dataset_config["num_classes"], device=device, node_loss_fn=node_loss_fn, precision=general_config["precision"], **kwargs)
     elif dataset_config["task_type"] == "multi-label-NC":
-        run_step = lambda *args, **kwargs: node_classification_step(*args, model=model, batch_size=params['batch_size'], loss_fn=loss_fn, optimizer=optimizer, enable_tqdm=general_config["tqdm"], sampling_strategy=sampling_strategy, device=device, multilabel=True, threshold=0, **kwargs)
-
+        run_step = lambda *args, **kwargs: node_classification_step(*args, model=step_model, batch_size=params['batch_size'], loss_fn=loss_fn, optimizer=optimizer, enable_tqdm=general_config["tqdm"], sampling_strategy=sampling_strategy, num_classes=dataset_config["num_classes"], device=device, multilabel=True, threshold=0, node_loss_fn=node_loss_fn, precision=general_config["precision"], **kwargs)
+
+    # Layer-wise full-graph inference for validation and testing
+    layerwise = use_layerwise_inference(config, model)
+    if layerwise:
+        logger.info("Using layer-wise full-graph inference for validation and testing.")
+        multilabel = dataset_config["task_type"] == "multi-label-NC"
+        layerwise_loaders = {}
+        for loader in [val_loader, test_loader]:
+            if id(loader.graph) not in layerwise_loaders:
+                layerwise_loaders[id(loader.graph)] = (get_node_features(loader), get_layerwise_loader(loader.graph, config))
+
+        def run_predict_step(mode, epoch, loader, outputs):
+            # Splits sharing one graph (transductive) share one layer-wise pass of the epoch.
+            if id(loader.graph) not in outputs:
+                x, layerwise_loader = layerwise_loaders[id(loader.graph)]
+                outputs[id(loader.graph)] = layerwise_inference(
+                    model, x, layerwise_loader, enable_tqdm=general_config["tqdm"], device=device,
+                    precision=general_config["precision"])
+            return node_classification_layerwise_step(
+                mode, epoch, loader, outputs[id(loader.graph)], loss_fn=loss_fn, num_classes=dataset_config["num_classes"],
+                multilabel=multilabel, threshold=0)
+
+    def run_test_step(epoch):
+        if layerwise:
+            return run_predict_step("test", epoch, test_loader, outputs)
+        return run_step("test", epoch, test_loader)
+
+    # Shared by the loaders of a transductive split
+    feature_cache = getattr(getattr(train_loader, "graph_sampler", None), "feature_cache", None)
+
+    outputs = {}
+    start_epoch = 1
     best_epoch = 0
-    for epoch in range(1, 1+general_config["num_epochs"]):
+    best_report = None
+    if resume_run_id is not None:
+        snapshots.load(checkpoint)
+        start_epoch = checkpoint["epoch"] + 1
+        best_value, best_epoch, best_report = checkpoint["best_value"], checkpoint["best_epoch"], checkpoint["best_report"]
+
+    for epoch in range(start_epoch, 1+general_config["num_epochs"]):
         if general_config["tqdm"]:
             print(f"Epoch {epoch}:")
         # Batch training
         train_loss, train_f1 = run_step("train", epoch, train_loader)
+        if epoch == start_epoch and isinstance(step_model, CompiledModel) and step_model.stats is not None:
+            for key, value in step_model.stats.items():
+                tracking.log_metric(key, value, epoch)
 
         # Validation
-        val_loss, val_f1 = run_step("val", epoch, val_loader)
-
-        # Test
-        test_f1, truths, predictions = run_step("test", epoch, test_loader)
-
-        logger.info(
-            f"Epoch {epoch}: train_loss={train_loss:<8.6g}, train_f1={train_f1:<8.6g}, val_loss={val_loss:<8.6g}, val_f1={val_f1:<8.6g}, test_f1={test_f1:<8.6g}")
+        if layerwise:
+            outputs = {}
+            val_loss, val_f1 = run_predict_step("val", epoch, val_loader, outputs)
+        else:
+            val_loss, val_f1 = run_step("val", epoch, val_loader)
 
         # Best model
         if criterion == "loss":
             criterion_value = -val_loss
         elif criterion == "f1":
             criterion_value = val_f1
+        improved = criterion_value > best_value
+
+        # Test
+        test_f1 = None
+        if should_eval_test(general_config, epoch, improved):
+            test_f1, test_metrics = run_test_step(epoch)
 
-        if criterion_value > best_value:
+        test_f1_str = f"{test_f1:<8.6g}" if test_f1 is not None else "skipped"
+        logger.info(
+            f"Epoch {epoch}: train_loss={train_loss:<8.6g}, train_f1={train_f1:<8.6g}, val_loss={val_loss:<8.6g}, val_f1={val_f1:<8.6g}, test_f1={test_f1_str}")
+
+        if improved:
             best_value = criterion_value
-            mlflow.log_metric("Best Test F1", test_f1, epoch)
+            if test_f1 is not None:
+                tracking.log_metric("Best Test F1", test_f1, epoch)
+                best_report = test_metrics.report()
 
-            best_model_state_dict = copy.deepcopy(model.state_dict())
-            best_report = classification_report(
-                truths, predictions, zero_division=0)
+            snapshots.snapshot(epoch)
             best_epoch = epoch
 
-            if general_config["save_model"]:
-                torch.save(
-                    {
-                        'epoch': epoch,
-                        'optimizer_state_dict': optimizer.state_dict(),
-                    },
-                    save_path
-                )
+        if feature_cache is not None:
+            for key, value in feature_cache.pop_stats().items():
+                tracking.log_metric(key, value, epoch)
+
+        snapshots.checkpoint(epoch, best_value=best_value, best_report=best_report)
 
         # Early Stopping
         if epoch-best_epoch > patience:
             logger.info("Patience reached. Early stop the trainning.")
             break
 
-    model.load_state_dict(best_model_state_dict)
+    checkpoint_path = snapshots.close()
+    snapshots.restore()
+    if general_config["test_eval_mode"] == "end":
+        # Test the best weights once.
+        outputs = {}
+        test_f1, test_metrics = run_test_step(best_epoch)
+        logger.info(f"Best epoch {best_epoch}: test_f1={test_f1:<8.6g}")
+        tracking.log_metric("Best Test F1", test_f1, best_epoch)
+        best_report = test_metrics.report()
     if general_config["save_model"]:
 
         input_schema = Schema(
@@ -264,12 +390,16 @@ def train_gnn(config):
         output_schema = Schema([TensorSpec(np.dtype(np.float32), (-1, dataset_config["num_classes"]))])
         
 
+        # numpy has no bfloat16, so the signature keeps fp32 tensors and the compute precision is recorded as metadata.
         mlflow.pytorch.log_model(model,
                                  model_name,
                                  signature=ModelSignature(inputs=input_schema, outputs=output_schema),
+                                 metadata={"precision": general_config["precision"]},
                                  )
-        mlflow.log_artifact(save_path, "Optimizer States")
-        os.remove(save_path)
+        if checkpoint_path is not None:
+            mlflow.log_artifact(checkpoint_path, "Optimizer States")
+        else:
+            logger.warning("No best checkpoint was written; the optimizer states are not logged.")
 
         logger.debug(register_info)
 
@@ -307,6 +437,9 @@ def train_gnn(config):
         out_file.write(best_report)
     mlflow.log_artifact("logs/tmp/test_report.txt")
 
+    # The run is complete, so it no longer needs to be resumable
+    shutil.rmtree(save_dir)
+    tracking.end_async_logging()
 
     mlflow.end_run()
 
@@ -1,29 +1,21 @@
 import torch
 import copy
+import contextlib
 
 from loguru import logger
 from .model.GraphSAGE import GraphSAGE_DGL
 from .model.GAT import GAT_DGL_Custom
 from .model.GIN import GIN_DGL_Custom
 
-def get_class_pos_weights(dataset_config, train_loader):
-    total_num = 0
-    pos_cnt = torch.zeros(dataset_config["num_classes"], dtype=int)
-    for batch in train_loader:
-        total_num += batch.y.shape[0]
-        pos_cnt = pos_cnt + batch.y.sum(axis=0)
-    neg_cnt = total_num - pos_cnt
-    return neg_cnt/pos_cnt
-        
-
-def get_loss_fn(config, train_loader, reduction="sum"):
+def get_loss_fn(config, class_stats, reduction="sum"):
+    """Loss of the task. `class_stats` are the class statistics of the training labels (see class_stats.py)."""
     dataset_config = config["dataset_config"]
     if dataset_config["task_type"] == "single-label-NC":
         return torch.nn.CrossEntropyLoss(reduction=reduction)
     
     elif dataset_config["task_type"] == "multi-label-NC":
         if config["hyperparameters"]["weighted_BCE"]:
-            pos_weight = get_class_pos_weights(dataset_config, train_loader)
+            pos_weight = torch.tensor(class_stats["pos_weight"])
         else:
             pos_weight = torch.ones(dataset_config["num_classes"])
         return torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight, reduction=reduction)
@@ -31,6 +23,65 @@ def get_loss_fn(config, train_loader, reduction="sum"):
         logger.exception(NotImplementedError("Unsupported task type!"))
 
 
+def get_weighted_loss(node_loss_fn, outputs, targets, node_weight):
+    """Self-normalized node-weighted loss, e.g., with GraphSAINT's node_norm.
+
+    `node_loss_fn` must be created with reduction="none".
+    """
+    loss = node_loss_fn(outputs, targets)
+    if loss.dim() > 1:
+        loss = loss.mean(dim=-1)
+    return (loss * node_weight).sum() / node_weight.sum()
+
+
+def get_autocast(device, precision="fp32"):
+    """Autocast context of the forward pass. bf16 needs no loss scaling, as it has the exponent range of fp32."""
+    if precision == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def get_general_option(config, key, default=None):
+    """Read a general option, giving priority to the command line.
+
+    Evaluation and inference replace general_config with the archived one of the
+    loaded model, which may predate newer options.
+    """
+    value = config.get("vargs", {}).get(key)
+    if value is None:
+        value = config["general_config"].get(key, default)
+    return value
+
+
+def use_layerwise_inference(config, model):
+    """Whether val/test/inference predictions can be computed layer by layer.
+
+    Layer-wise inference is exact only when all neighbors are used for prediction,
+    so it is restricted to unsampled prediction over node-level loaders.
+    """
+    general_config = config["general_config"]
+    return (
+        get_general_option(config, "layerwise_inference", True)
+        and not general_config["sample_when_predict"]
+        and general_config["sampling_strategy"] in ["SAGE", "SAINT", "Cluster", None, "None"]
+        and getattr(model, "supports_layerwise_inference", False)
+    )
+
+
+def should_eval_test(general_config, epoch, improved):
+    """Whether to evaluate the test split after the validation step of `epoch`.
+
+    test_eval_mode "always" tests every epoch, "on_improve" only when validation improves
+    and "end" once on the best weights after training. In addition, the test split is
+    evaluated every test_eval_every epochs if set.
+    """
+    test_eval_mode = general_config["test_eval_mode"]
+    test_eval_every = general_config["test_eval_every"]
+    if test_eval_every and epoch % test_eval_every == 0:
+        return True
+    return test_eval_mode == "always" or (test_eval_mode == "on_improve" and improved)
+
+
 def filter_config_for_archive(config):
     archive_config = {
         "general_config": copy.deepcopy(config["general_config"]),
@@ -88,12 +139,11 @@ def get_model(config):
                 hidden_dim=model_config.pop("hidden_node_channels"),
                 output_dim=dataset_config["num_classes"],
                 num_lin_layers=model_config.pop("num_lin_layers"),
-                num_gcn_layers=model_config.pop("num_gcn_layers"),
+                # Named num_layers in the config, as for the other models (used by the loaders).
+                num_gcn_layers=model_config.pop("num_layers"),
                 aggregator_type=model_config.pop("aggregator_type"),
                 init_eps=model_config.pop("init_eps"),
                 learn_eps=model_config.pop("learn_eps"),
-                mlp_activation='relu',
-                gin_activation='relu',
                 dropout=model_config.pop("dropout"),
                 mlp_dropout=model_config.pop("mlp_dropout"),
                 mlp_bias=model_config.pop("mlp_bias"),
@@ -0,0 +1,55 @@
+import torch
+import torch.multiprocessing as mp
+
+
+class FeatureCache:
+    """Degree-aware cache of the node features gathered into sampled batches.
+
+    On power-law graphs the same hubs are sampled into nearly every batch. The
+    features of the `capacity` nodes with the highest degree are copied once
+    into a compact contiguous buffer; the features of the other nodes are
+    gathered from `x` itself, e.g. the memory-mapped feature store of the data
+    cache, which then only pages in the long tail.
+
+    Hit and gathered-byte counters live in shared memory behind a process
+    lock, so that gathers in concurrent loader workers are all counted.
+    `pop_stats` returns and resets them.
+    """
+
+    def __init__(self, x, degree, capacity):
+        self.x = x
+        self.capacity = min(capacity, x.shape[0])
+        hot = degree.topk(self.capacity).indices.sort().values
+        self.hot_x = x[hot].contiguous()
+        self.slot = torch.full((x.shape[0],), -1, dtype=torch.long)
+        self.slot[hot] = torch.arange(self.capacity)
+        self.hot_x.share_memory_()
+        self.slot.share_memory_()
+        # Lookups, hits and bytes gathered from the store.
+        self.counters = torch.zeros(3, dtype=torch.long).share_memory_()
+        self.lock = mp.Lock()
+        self.row_bytes = x[:1].numel() * x.element_size()
+
+    def __getitem__(self, n_id):
+        slot = self.slot[n_id]
+        hit = slot >= 0
+        miss = (~hit).nonzero().view(-1)
+        out = torch.empty((n_id.numel(), *self.x.shape[1:]), dtype=self.x.dtype)
+        out[hit] = self.hot_x[slot[hit]]
+        out[miss] = self.x[n_id[miss]]
+
+        num_hits = n_id.numel() - miss.numel()
+        with self.lock:
+            self.counters += torch.tensor([n_id.numel(), num_hits, miss.numel() * self.row_bytes])
+        return out
+
+    def pop_stats(self):
+        with self.lock:
+            lookups, hits, bytes_gathered = self.counters.tolist()
+            self.counters.zero_()
+        return {
+            "feature cache hit rate": hits / lookups if lookups else 0.0,
+            "feature cache bytes gathered": bytes_gathered,
+            "feature cache bytes saved": hits * self.row_bytes,
+        }
+
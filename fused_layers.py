@@ -0,0 +1,35 @@
+import torch
+import torch.nn.functional as F
+
+from torch.nn import Linear, BatchNorm1d
+
+
+class LinearBNReLU(torch.nn.Module):
+    """Linear layer followed by batch norm and ReLU.
+
+    In eval mode, the batch norm is an affine map of the running statistics,
+    so it is folded into the weights and bias of the linear layer and the
+    block runs as a single fused linear + ReLU.
+    """
+
+    def __init__(self, in_channels, out_channels, bias=True):
+        super().__init__()
+        self.lin = Linear(in_channels, out_channels, bias=bias)
+        self.norm = BatchNorm1d(out_channels)
+
+    def reset_parameters(self):
+        self.lin.reset_parameters()
+        self.norm.reset_parameters()
+
+    def forward(self, x):
+        if self.training:
+            return F.relu(self.norm(self.lin(x)))
+        weight, bias = self.fold()
+        return F.linear(x, weight, bias).relu_()
+
+    @torch.no_grad()
+    def fold(self):
+        """Weight and bias of the linear layer with the eval-mode batch norm folded in."""
+        scale = self.norm.weight * (self.norm.running_var + self.norm.eps).rsqrt()
+        bias = -self.norm.running_mean if self.lin.bias is None else self.lin.bias - self.norm.running_mean
+        return self.lin.weight * scale[:, None], bias * scale + self.norm.bias
@@ -0,0 +1,149 @@
+import torch
+import torch.distributed as dist
+
+
+class MetricAccumulator:
+    """Streaming node classification metrics.
+
+    Per-class counts of true positives, predictions and truths are updated
+    batch by batch on the device of the predictions, so memory is
+    O(num_classes) regardless of the number of nodes. `f1` and `report`
+    give the same values as sklearn's `f1_score` and `classification_report`
+    with zero_division=0.
+    """
+
+    def __init__(self, num_classes, multilabel=False):
+        self.num_classes = num_classes
+        self.multilabel = multilabel
+        self.num_samples = 0
+        self.tp = None
+        self.pred_count = None
+        self.true_count = None
+        # Sums of the per-sample precision, recall and F1 (multi-label "samples avg").
+        self.sample_sums = None
+
+    def _init_counts(self, device):
+        self.tp = torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        self.pred_count = torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        self.true_count = torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        self.sample_sums = torch.zeros(3, dtype=torch.float64, device=device)
+
+    @torch.no_grad()
+    def update(self, preds, targets):
+        """Add a batch of predictions (class indices or multi-label indicators)."""
+        if self.tp is None:
+            self._init_counts(preds.device)
+        targets = targets.to(preds.device)
+
+        if self.multilabel:
+            preds = preds.bool()
+            targets = targets.bool()
+            tp = preds & targets
+            self.tp += tp.sum(dim=0)
+            self.pred_count += preds.sum(dim=0)
+            self.true_count += targets.sum(dim=0)
+
+            tp, num_preds, num_trues = tp.sum(dim=1), preds.sum(dim=1), targets.sum(dim=1)
+            precision = _safe_divide(tp, num_preds)
+            recall = _safe_divide(tp, num_trues)
+            f1 = _safe_divide(2 * tp, num_preds + num_trues)
+            self.sample_sums += torch.stack([precision.sum(), recall.sum(), f1.sum()])
+        else:
+            preds = preds.view(-1).long()
+            targets = targets.view(-1).long()
+            self.tp += torch.bincount(targets[preds == targets], minlength=self.num_classes)
+            self.pred_count += torch.bincount(preds, minlength=self.num_classes)
+            self.true_count += torch.bincount(targets, minlength=self.num_classes)
+
+        self.num_samples += targets.shape[0]
+
+    def all_reduce(self):
+        """Sum the counts over all processes of a torch.distributed process group."""
+        if self.tp is None:
+            self._init_counts("cpu")
+        counts = torch.cat([self.tp, self.pred_count, self.true_count, torch.tensor([self.num_samples], device=self.tp.device)])
+        dist.all_reduce(counts)
+        dist.all_reduce(self.sample_sums)
+        self.tp, self.pred_count, self.true_count = counts[:-1].split(self.num_classes)
+        self.num_samples = int(counts[-1])
+        return self
+
+    def labels(self):
+        # Like sklearn: all columns for multi-label, otherwise the classes seen in truths or predictions.
+        if self.multilabel:
+            return torch.arange(self.num_classes)
+        return ((self.pred_count + self.true_count) > 0).nonzero().view(-1).cpu()
+
+    def per_class(self):
+        """Precision, recall, F1 and support of each label in `labels()`."""
+        labels = self.labels()
+        tp = self.tp.cpu()[labels].double()
+        pred_count = self.pred_count.cpu()[labels].double()
+        true_count = self.true_count.cpu()[labels].double()
+        precision = _safe_divide(tp, pred_count)
+        recall = _safe_divide(tp, true_count)
+        f1 = _safe_divide(2 * tp, pred_count + true_count)
+        return precision, recall, f1, true_count.long()
+
+    def averages(self):
+        """Rows of (name, precision, recall, F1, support) for the averages."""
+        precision, recall, f1, support = self.per_class()
+        total = int(support.sum())
+
+        tp = self.tp.sum().double()
+        pred_count = self.pred_count.sum().double()
+        true_count = self.true_count.sum().double()
+        rows = [("micro", _safe_divide(tp, pred_count).item(), _safe_divide(tp, true_count).item(),
+                 _safe_divide(2 * tp, pred_count + true_count).item(), total)]
+
+        rows.append(("macro", precision.mean().item(), recall.mean().item(), f1.mean().item(), total))
+
+        weights = support.double() / total if total > 0 else torch.zeros_like(precision)
+        rows.append(("weighted", (precision * weights).sum().item(), (recall * weights).sum().item(),
+                     (f1 * weights).sum().item(), total))
+
+        if self.multilabel:
+            sample_avg = (self.sample_sums / max(self.num_samples, 1)).tolist()
+            rows.append(("samples", *sample_avg, total))
+        return rows
+
+    def f1(self, average="micro"):
+        if self.tp is None:
+            return 0.
+        for name, _, _, f1, _ in self.averages():
+            if name == average:
+                return f1
+        raise ValueError(f"Unsupported average: {average}")
+
+    def report(self, digits=2):
+        """Text report in the format of sklearn's classification_report."""
+        if self.tp is None:
+            return ""
+        labels = [str(label) for label in self.labels().tolist()]
+        precision, recall, f1, support = self.per_class()
+
+        headers = ["precision", "recall", "f1-score", "support"]
+        width = max([len(label) for label in labels] + [len("weighted avg"), digits])
+        head_fmt = "{:>{width}s} " + " {:>9}" * len(headers)
+        report = head_fmt.format("", *headers, width=width)
+        report += "\n\n"
+        row_fmt = "{:>{width}s} " + " {:>9.{digits}f}" * 3 + " {:>9}\n"
+        for row in zip(labels, precision.tolist(), recall.tolist(), f1.tolist(), support.tolist()):
+            report += row_fmt.format(*row, width=width, digits=digits)
+        report += "\n"
+
+        for name, avg_precision, avg_recall, avg_f1, total in self.averages():
+            if name == "micro" and not self.multilabel:
+                # Micro average is the accuracy for single-label classification.
+                row_fmt_accuracy = "{:>{width}s} " + " {:>9.{digits}}" * 2 + " {:>9.{digits}f}" + " {:>9}\n"
+                report += row_fmt_accuracy.format("accuracy", "", "", avg_f1, total, width=width, digits=digits)
+            else:
+                report += row_fmt.format(f"{name} avg", avg_precision, avg_recall, avg_f1, total,
+                                         width=width, digits=digits)
+        return report
+
+
+def _safe_divide(numerator, denominator):
+    numerator = numerator.double()
+    denominator = denominator.double()
+    return torch.where(denominator > 0, numerator / denominator.clamp(min=1), torch.zeros_like(numerator))
@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from loguru import logger
+
+
+OUTPUT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+class PredictionWriter:
+    """Stream node predictions to a Parquet or Arrow IPC file, batch by batch.
+
+    Each call to `write` appends one record batch with the columns `n_id`,
+    `pred` (or `pred_1`, ..., `pred_k` for multi-label predictions) and
+    optionally the probabilities and the truths (`truth` or `truth_1`, ...,
+    `truth_k`). The probabilities are named after the predictions they go
+    with: `prob_0`, ..., `prob_{k-1}` for the class indices in `pred`, and
+    `prob_1`, ..., `prob_k` next to `pred_1`, ..., `pred_k`. Only the current
+    batch is held in memory. Multi-label predictions and truths are stored as
+    booleans.
+
+    The file is written to a temporary path and moved into place on `close`,
+    so an interrupted run never leaves a truncated file behind.
+    """
+
+    def __init__(self, path, output_format="parquet", compression="zstd"):
+        self.path = path
+        self.output_format = output_format
+        self.compression = compression
+        self.tmp_path = path + ".tmp"
+        self.writer = None
+        self.num_rows = 0
+
+    def write(self, n_ids, preds, probs=None, truths=None):
+        columns = {"n_id": _numpy(n_ids).astype(np.int64)}
+        preds = _numpy(preds)
+        columns.update(_columns("pred", preds, kind="bool"))
+        if probs is not None:
+            # Class indices are 0-based, multi-label columns 1-based.
+            columns.update(_columns("prob", _numpy(probs), kind="prob", start=0 if preds.ndim == 1 else 1))
+        if truths is not None:
+            columns.update(_columns("truth", _numpy(truths), kind="bool"))
+        batch = pa.RecordBatch.from_pydict(columns)
+
+        if self.writer is None:
+            self.writer = self._open(batch.schema)
+        self.writer.write_batch(batch)
+        self.num_rows += batch.num_rows
+
+    def _open(self, schema):
+        save_dir = os.path.dirname(self.path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        if self.output_format == "parquet":
+            return pq.ParquetWriter(self.tmp_path, schema, compression=self.compression)
+        return pa.ipc.new_file(self.tmp_path, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+
+    def close(self):
+        if self.writer is None:
+            logger.warning(f"No nodes to predict; {self.path} is not written.")
+            return
+        self.writer.close()
+        self.writer = None
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"{self.num_rows} predictions are saved at {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer.close()
+            os.remove(self.tmp_path)
+
+
+def get_prediction_path(output_dir, name, split, output_format="parquet"):
+    return os.path.join(output_dir, name, f"{split}-pred{OUTPUT_FORMATS[output_format]}")
+
+
+def _numpy(value):
+    return value.detach().cpu().numpy() if hasattr(value, "detach") else np.asarray(value)
+
+
+def _columns(prefix, values, kind="bool", start=1):
+    """Columns of predictions or truths (kind "bool") or of probabilities (kind "prob").
+
+    Class indices are one integer column. Multi-label predictions and truths
+    (whatever their dtype, e.g. float labels) and probabilities are one column
+    per class, numbered from `start`, of booleans or float32 respectively.
+    """
+    if kind == "bool" and values.ndim == 1:
+        return {prefix: values}
+    values = values.reshape(values.shape[0], -1)
+    values = values.astype(bool) if kind == "bool" else values.astype(np.float32)
+    return {f"{prefix}_{i + start}": values[:, i] for i in range(values.shape[1])}
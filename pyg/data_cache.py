@@ -0,0 +1,170 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import torch
+
+from torch_geometric.data import Data
+from loguru import logger
+
+from .train_utils import get_general_option
+
+
+CACHE_VERSION = 1
+SPLITS = ["train", "val", "test"]
+# Addresses of the memory-mapped arrays, whose pages are already shared between processes through the page cache.
+MAPPED_STORAGES = set()
+
+
+def get_cache_key(config, transform):
+    """Everything that changes the content of the preprocessed splits."""
+    general_config = config["general_config"]
+    return {
+        "version": CACHE_VERSION,
+        "library": "pyg",
+        "dataset": config["dataset"],
+        "transform": repr(transform),
+        "framework": general_config["framework"],
+        "SAGE_inductive_option": general_config["SAGE_inductive_option"],
+        "feature_precision": get_general_option(config, "cache_feature_precision", "fp32"),
+    }
+
+
+def get_cache_dir(config, transform):
+    key = get_cache_key(config, transform)
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    cache_root = config["general_config"].get("cache_dir", "dataset/cache")
+    return os.path.join(cache_root, f"{config['dataset']}-{digest}")
+
+
+def save_graph(data: Data, graph_dir, feature_precision="fp32"):
+    """Save a graph with its topology as CSR over the destination nodes.
+
+    Edges are sorted by destination, so `edge_index` rebuilt on load is
+    column-sorted. Node features are saved for memory-mapping on load, as
+    raw 16-bit words if `feature_precision` is "bf16" (numpy has no bfloat16).
+    """
+    os.makedirs(graph_dir)
+    num_nodes = data.num_nodes
+    row, col = data.edge_index
+    perm = torch.argsort(col * num_nodes + row)
+
+    indptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    indptr[1:] = torch.bincount(col, minlength=num_nodes).cumsum(0)
+    np.save(os.path.join(graph_dir, "indptr.npy"), indptr.numpy())
+    np.save(os.path.join(graph_dir, "indices.npy"), row[perm].numpy())
+
+    node_attrs, edge_attrs = [], []
+    for key, value in data.items():
+        if key == "edge_index" or not isinstance(value, torch.Tensor):
+            continue
+        if data.is_edge_attr(key):
+            value = value[perm]
+            edge_attrs.append(key)
+        else:
+            node_attrs.append(key)
+        if key == "x" and feature_precision == "bf16":
+            value = value.to(torch.bfloat16).view(torch.int16)
+        np.save(os.path.join(graph_dir, f"{key}.npy"), value.numpy())
+
+    with open(os.path.join(graph_dir, "meta.json"), "w") as out_file:
+        json.dump({"num_nodes": num_nodes, "node_attrs": node_attrs, "edge_attrs": edge_attrs,
+                   "feature_precision": feature_precision}, out_file)
+
+
+def load_graph(graph_dir):
+    with open(os.path.join(graph_dir, "meta.json")) as in_file:
+        meta = json.load(in_file)
+
+    indptr = torch.from_numpy(np.load(os.path.join(graph_dir, "indptr.npy")))
+    row = torch.from_numpy(np.load(os.path.join(graph_dir, "indices.npy")))
+    col = torch.repeat_interleave(torch.arange(meta["num_nodes"]), indptr.diff())
+
+    attrs = {}
+    for key in meta["node_attrs"] + meta["edge_attrs"]:
+        path = os.path.join(graph_dir, f"{key}.npy")
+        # Copy-on-write memory map for features, so that they are paged in on demand.
+        attrs[key] = load_mmap(path) if key == "x" else torch.from_numpy(np.load(path))
+    if meta.get("feature_precision") == "bf16":
+        attrs["x"] = attrs["x"].view(torch.bfloat16)
+
+    return Data(edge_index=torch.stack([row, col]), num_nodes=meta["num_nodes"], **attrs)
+
+
+def load_mmap(path):
+    """Copy-on-write memory map of a .npy file as a tensor."""
+    tensor = torch.from_numpy(np.load(path, mmap_mode="c"))
+    MAPPED_STORAGES.add(tensor.untyped_storage().data_ptr())
+    return tensor
+
+
+def is_memory_mapped(tensor):
+    return tensor.untyped_storage().data_ptr() in MAPPED_STORAGES
+
+
+def make_tmp_dir(cache_dir):
+    """Temporary directory next to `cache_dir`, unique to the caller so that concurrent runs never share one."""
+    parent = os.path.dirname(cache_dir) or "."
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + ".", suffix=".tmp", dir=parent)
+
+
+def publish_dir(tmp_dir, cache_dir):
+    """Move `tmp_dir` to `cache_dir` atomically.
+
+    Returns False, discarding `tmp_dir`, if another run published `cache_dir` first.
+    """
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+        shutil.rmtree(tmp_dir)
+        return False
+    return True
+
+
+def save_data_cache(cache_dir, train_data, val_data, test_data, key, feature_precision="fp32"):
+    """Save the preprocessed splits. Splits sharing one graph are saved once."""
+    tmp_dir = make_tmp_dir(cache_dir)
+    try:
+        graphs = {}
+        splits = {}
+        for split, data in zip(SPLITS, [train_data, val_data, test_data]):
+            if id(data) not in graphs:
+                graphs[id(data)] = f"graph{len(graphs)}"
+                save_graph(data, os.path.join(tmp_dir, graphs[id(data)]), feature_precision=feature_precision)
+            splits[split] = graphs[id(data)]
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as out_file:
+            json.dump({"key": key, "splits": splits}, out_file, indent=2)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # Publish atomically, so that an interrupted run never leaves a partial cache behind.
+    if publish_dir(tmp_dir, cache_dir):
+        logger.info(f"Preprocessed dataset is cached at {cache_dir}")
+    else:
+        logger.info(f"Preprocessed dataset was already cached at {cache_dir} by another run")
+
+
+def load_data_cache(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json")) as in_file:
+        meta = json.load(in_file)
+
+    graphs = {}
+    for name in set(meta["splits"].values()):
+        graphs[name] = load_graph(os.path.join(cache_dir, name))
+
+    logger.info(f"Loaded preprocessed dataset from {cache_dir}")
+    return tuple(graphs[meta["splits"][split]] for split in SPLITS)
+
+
+def get_split_graph(cache_dir, split):
+    """Name of the cached graph of `split`. Splits sharing one graph share its name."""
+    with open(os.path.join(cache_dir, "meta.json")) as in_file:
+        return json.load(in_file)["splits"][split]
@@ -1,12 +1,25 @@
+import os
 import torch
 import torch_geometric.transforms as T
 
+from torch.utils.data import DataLoader as TorchDataLoader, DistributedSampler
 from torch_geometric.data import Data, Batch
 from torch_geometric.loader import NeighborLoader, DataLoader
+from torch_geometric.sampler import NeighborSampler
+from torch_geometric.utils import degree
+from torch_geometric.loader import GraphSAINTNodeSampler, GraphSAINTEdgeSampler, GraphSAINTRandomWalkSampler
 
-from copy import deepcopy
+from copy import copy, deepcopy
 from loguru import logger
 
+from class_stats import get_class_stats
+from feature_cache import FeatureCache
+from .partition import get_partition, ClusterBatcher
+from .data_cache import get_cache_dir, get_cache_key, save_data_cache, load_data_cache, is_memory_mapped
+from .train_utils import get_general_option
+from .multiplex import multiplex_loaders, SplitLoader
+from .distributed import is_distributed, get_world_size, shard_seed_nodes
+
 
 def merge_from_data_list(data_list):
     batch_data = Batch.from_data_list(data_list)
@@ -20,8 +33,26 @@ def merge_from_data_list(data_list):
     return data
 
 
+def get_transform(config):
+    if config["dataset"] == "PPI":
+        return None
+    return T.Compose([T.NormalizeFeatures()])
+
+
 def get_data_SAGE(config):
-    transform = T.Compose([T.NormalizeFeatures()])
+    if not get_general_option(config, "data_cache", True):
+        return load_data_SAGE(config)
+
+    transform = get_transform(config)
+    cache_dir = get_cache_dir(config, transform)
+    if not os.path.exists(cache_dir):
+        save_data_cache(cache_dir, *load_data_SAGE(config), key=get_cache_key(config, transform),
+                        feature_precision=get_general_option(config, "cache_feature_precision", "fp32"))
+    return load_data_cache(cache_dir)
+
+
+def load_data_SAGE(config):
+    transform = get_transform(config)
     dataset = config["dataset"]
     if dataset in ['Cora', 'CiteSeer', 'PubMed']:
         from torch_geometric.datasets import Planetoid
@@ -88,8 +119,8 @@ def get_data_SAGE(config):
 
 
 def get_data_SAINT(config):
-    dataset_config = config["dataset_config"]
-    logger.exception('Not Implemented.')
+    # GraphSAINT samples subgraphs of the training graph, so the splits are the same as for SAGE.
+    return get_data_SAGE(config)
 
 
 def get_data_graph_batch(config):
@@ -103,59 +134,209 @@ def get_data_graph_batch(config):
         
     
 
-def get_loader_SAGE(train_data, val_data, test_data, config):
+def get_neighbor_loader(data: Data, num_neighbors, samplers: dict, feature_cache_size=None, **kwargs):
+    """NeighborLoader sharing the sampling topology of the other loaders over the same graph.
+
+    The CSC topology of each graph is built once per `samplers` dict, so the
+    train/val/test loaders of a transductive split share one copy and only
+    differ in their fan-out. With loader workers, the in-memory tensors of
+    the graph are moved to shared memory once and mapped by all workers of
+    all loaders, and memory-mapped features stay file-backed. Graphs from the data cache are already sorted by destination, so
+    their CSC reuses `edge_index` instead of sorting a permuted copy.
+
+    With `feature_cache_size`, the features of the most connected nodes are
+    served from a FeatureCache shared by the loaders of the graph, and the
+    other features stay in place (e.g. memory-mapped) instead of being moved
+    to shared memory.
+    """
+    if id(data) not in samplers:
+        loader_data = data
+        feature_cache = None
+        if feature_cache_size and "x" in data:
+            # Sampled as a source node, i.e. as a neighbor of the seed nodes.
+            feature_cache = FeatureCache(data.x, degree(data.edge_index[0], data.num_nodes), feature_cache_size)
+            loader_data = copy(data)
+            loader_data.num_nodes = data.num_nodes
+            del loader_data.x
+
+        share_memory = kwargs.get("num_workers", 0) > 0
+        if share_memory:
+            share_in_memory_tensors(loader_data)
+        col = data.edge_index[1]
+        neighbor_sampler = NeighborSampler(
+            loader_data, num_neighbors=num_neighbors, is_sorted=bool((col[1:] >= col[:-1]).all()), share_memory=share_memory)
+        samplers[id(data)] = (neighbor_sampler, loader_data, feature_cache)
+
+    neighbor_sampler, loader_data, feature_cache = samplers[id(data)]
+    neighbor_sampler = copy(neighbor_sampler)
+    neighbor_sampler.num_neighbors = num_neighbors
+    if feature_cache is not None:
+        return FeatureCacheLoader(loader_data, feature_cache, data, num_neighbors=num_neighbors, neighbor_sampler=neighbor_sampler, **kwargs)
+    return NeighborLoader(data, num_neighbors=num_neighbors, neighbor_sampler=neighbor_sampler, **kwargs)
+
+
+def share_in_memory_tensors(data: Data):
+    """Move the tensors of `data` to shared memory, except the memory-mapped features of the data cache.
+
+    Sharing a memory-mapped tensor would copy the whole file into shared
+    memory, while its pages are already shared with the workers through the
+    page cache.
+    """
+    for _, value in data.items():
+        if isinstance(value, torch.Tensor) and not is_memory_mapped(value):
+            value.share_memory_()
+
+
+class FeatureCacheLoader(NeighborLoader):
+    """NeighborLoader gathering the node features of its batches through a FeatureCache.
+
+    Batches are sampled and filtered from a copy of `graph` without features.
+    """
+
+    def __init__(self, data: Data, feature_cache: FeatureCache, graph: Data, **kwargs):
+        super().__init__(data, **kwargs)
+        self.feature_cache = feature_cache
+        self.graph = graph
+
+    def filter_fn(self, out):
+        batch = super().filter_fn(out)
+        batch.x = self.feature_cache[batch.n_id]
+        return batch
+
+
+def get_graph(loader):
+    """Full graph of a node-level loader, including the features served by a feature cache."""
+    return getattr(loader, "graph", loader.data)
+
+
+def get_num_neighbors(config, predict=False):
+    """Number of neighbors sampled per layer, or all of them when predicting without sample_when_predict."""
     model_config = config["model_config"]
+    if predict and not config["general_config"]["sample_when_predict"]:
+        logger.warning(
+            "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
+        return [-1] * model_config["num_layers"]
+
     num_neighbors = model_config.get("num_neighbors", -1)
     if type(num_neighbors) == int:
-        num_neighbors = [num_neighbors] * model_config["num_layers"]
-    elif type(num_neighbors) == list:
-        num_neighbors = num_neighbors
-        assert len(num_neighbors) == model_config["num_layers"]
+        return [num_neighbors] * model_config["num_layers"]
+    assert len(num_neighbors) == model_config["num_layers"]
+    return list(num_neighbors)
 
-    params = config["hyperparameters"]
-    
-    general_config = config["general_config"]
 
-    logger.info(
-        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+def get_predict_loaders(val_data, test_data, config, samplers=None):
+    """Validation and test loaders on full (or sampled) node-wise neighborhoods.
 
-    train_loader = NeighborLoader(
-        train_data,
-        num_neighbors=num_neighbors.copy(),
-        batch_size=params["batch_size"],
-        input_nodes=train_data.train_mask,
-        num_workers=general_config["num_workers"],
-        persistent_workers=general_config["persistent_workers"],
-    )
-
-    if not general_config["sample_when_predict"]:
-        logger.warning(
-            "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
-        num_neighbors = [-1] * model_config["num_layers"]
+    Used by every node-wise strategy (SAGE, SAINT, Cluster). `samplers` shares
+    the neighbor samplers and feature caches with the training loader.
+    """
+    params = config["hyperparameters"]
+    general_config = config["general_config"]
+    num_neighbors = get_num_neighbors(config, predict=True)
 
-    val_loader = NeighborLoader(
+    samplers = {} if samplers is None else samplers
+    val_loader = get_neighbor_loader(
         val_data,
         num_neighbors=num_neighbors,
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         input_nodes=val_data.val_mask,
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    test_loader = NeighborLoader(
+    test_loader = get_neighbor_loader(
         test_data,
         num_neighbors=num_neighbors,
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         input_nodes=test_data.test_mask,
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
+    return val_loader, test_loader
+
+
+def get_loader_SAGE(train_data, val_data, test_data, config):
+    params = config["hyperparameters"]
+    
+    general_config = config["general_config"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    samplers = {}
+    train_loader = get_neighbor_loader(
+        train_data,
+        num_neighbors=get_num_neighbors(config),
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
+        batch_size=params["batch_size"],
+        input_nodes=shard_seed_nodes(train_data.train_mask),
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config, samplers)
+
+    if get_general_option(config, "shared_loader_workers", True):
+        return multiplex_loaders(train_loader, val_loader, test_loader)
     return train_loader, val_loader, test_loader
 
 
-def get_loader_SAINT(data: Data, config):
-    logger.exception("Not implemented.")
+def get_SAINT_norm_dir(config):
+    """Directory caching the GraphSAINT normalization coefficients.
+
+    The coefficients depend on the training graph and on the sampler settings.
+    """
+    general_config = config["general_config"]
+    return "-".join([
+        get_cache_dir(config, get_transform(config)),
+        "SAINT",
+        general_config["SAINT_sampler"],
+        f"b{config['hyperparameters']['batch_size']}",
+        f"s{general_config['SAINT_num_steps']}",
+    ])
+
+
+def get_loader_SAINT(train_data, val_data, test_data, config):
+    params = config["hyperparameters"]
+    general_config = config["general_config"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    save_dir = get_SAINT_norm_dir(config)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    kwargs = dict(
+        batch_size=params["batch_size"],
+        # Distributed processes split the steps of an epoch between them.
+        num_steps=-(-general_config["SAINT_num_steps"] // get_world_size()),
+        sample_coverage=general_config["SAINT_sample_coverage"],
+        save_dir=save_dir,
+        log=general_config["tqdm"],
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+    match general_config["SAINT_sampler"]:
+        case "node":
+            train_loader = GraphSAINTNodeSampler(train_data, **kwargs)
+        case "edge":
+            train_loader = GraphSAINTEdgeSampler(train_data, **kwargs)
+        case "rw":
+            train_loader = GraphSAINTRandomWalkSampler(
+                train_data, walk_length=general_config["SAINT_walk_length"], **kwargs)
+        case _:
+            raise ValueError(f"Unrecognized SAINT sampler: {general_config['SAINT_sampler']}")
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config)
+
+    return train_loader, val_loader, test_loader
 
 
 def get_loader_no_sampling(train_data, val_data, test_data, config):
@@ -170,36 +351,114 @@ def get_loader_no_sampling(train_data, val_data, test_data, config):
     logger.info(
         f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
 
-    train_loader = NeighborLoader(
+    samplers = {}
+    train_loader = get_neighbor_loader(
         train_data,
         num_neighbors=num_neighbors,
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=train_data.num_nodes,
-        input_nodes=train_data.train_mask,
+        input_nodes=shard_seed_nodes(train_data.train_mask),
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    val_loader = NeighborLoader(
+    val_loader = get_neighbor_loader(
         val_data,
         num_neighbors=num_neighbors,
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=val_data.num_nodes,
         input_nodes=val_data.val_mask,
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
-    test_loader = NeighborLoader(
+    test_loader = get_neighbor_loader(
         test_data,
         num_neighbors=num_neighbors,
+        samplers=samplers,
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=test_data.num_nodes,
         input_nodes=test_data.test_mask,
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
     )
 
+    if get_general_option(config, "shared_loader_workers", True):
+        return multiplex_loaders(train_loader, val_loader, test_loader)
+    return train_loader, val_loader, test_loader
+
+
+def get_seed_nodes(loader, split):
+    """Nodes predicted for the given split of a node-level loader."""
+    if isinstance(loader, (NeighborLoader, SplitLoader)):
+        return loader.input_data.node
+    return getattr(loader.data, f"{split}_mask").nonzero().view(-1)
+
+
+def get_train_class_stats(train_loader, config):
+    """Class statistics of the training labels, read from the graph of the loader instead of its batches."""
+    if hasattr(train_loader, "data"):
+        data = train_loader.data
+        y, mask = data.y, data.train_mask
+    else:
+        # Graph batching: every node of the training graphs.
+        y, mask = torch.cat([data.y for data in train_loader.dataset]), None
+    save_path = f"{get_cache_dir(config, get_transform(config))}-class_stats.json"
+    return get_class_stats(y, mask, config["dataset_config"]["num_classes"], save_path=save_path)
+
+
+def get_data_Cluster(config):
+    # Clusters partition the training graph, so the splits are the same as for SAGE.
+    return get_data_SAGE(config)
+
+
+def get_loader_Cluster(train_data, val_data, test_data, config):
+    general_config = config["general_config"]
+    num_parts = general_config["Cluster_num_parts"]
+
+    logger.info(
+        f"\ntrain_data={train_data}\nval_data={val_data}\ntest_data={test_data}")
+
+    save_path = os.path.join(
+        f"{get_cache_dir(config, get_transform(config))}-Cluster", f"partition-{num_parts}.npy")
+    cluster = get_partition(train_data, num_parts, save_path)
+
+    # Each batch is the subgraph induced by several random clusters.
+    train_loader = TorchDataLoader(
+        shard_seed_nodes(torch.arange(num_parts)).tolist(),
+        batch_size=general_config["Cluster_parts_per_batch"],
+        shuffle=True,
+        collate_fn=ClusterBatcher(train_data, cluster, num_parts),
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+    train_loader.data = train_data
+
+    val_loader, test_loader = get_predict_loaders(val_data, test_data, config)
+
     return train_loader, val_loader, test_loader
 
 
+def get_layerwise_loader(data: Data, config):
+    """Loader over full 1-hop neighborhoods of all nodes for layer-wise inference.
+
+    Only the topology is handed to the loader; the node embeddings of each layer
+    are gathered by `pyg.inference.layerwise_inference` itself.
+    """
+    general_config = config["general_config"]
+
+    return get_neighbor_loader(
+        Data(edge_index=data.edge_index, num_nodes=data.num_nodes),
+        num_neighbors=[-1],
+        samplers={},
+        batch_size=config["hyperparameters"]["batch_size"],
+        num_workers=general_config["num_workers"],
+        persistent_workers=general_config["persistent_workers"],
+    )
+
+
 def get_loader_graph_batch(train_dataset, val_dataset, test_dataset, config):
     batch_size = config["hyperparameters"]["batch_size"]
     general_config = config["general_config"]
@@ -207,6 +466,7 @@ def get_loader_graph_batch(train_dataset, val_dataset, test_dataset, config):
     train_loader = DataLoader(
         train_dataset, 
         batch_size=batch_size,
+        sampler=DistributedSampler(train_dataset, shuffle=False) if is_distributed() else None,
         num_workers=general_config["num_workers"],
         persistent_workers=general_config["persistent_workers"],
         )
@@ -238,6 +498,8 @@ def get_loader(config):
         return get_loader_SAGE(*get_data_SAGE(config), config)
     elif sampling_strategy == 'SAINT':
         return get_loader_SAINT(*get_data_SAINT(config), config)
+    elif sampling_strategy == 'Cluster':
+        return get_loader_Cluster(*get_data_Cluster(config), config)
     elif sampling_strategy == 'GraphBatching':
         return get_loader_graph_batch(*get_data_graph_batch(config), config)
     elif sampling_strategy == 'None' or sampling_strategy == None:
@@ -279,20 +541,12 @@ def get_inference_data_SAGE(config):
             return unlabelled_data
     
 def get_inference_data_SAINT(config):
-    pass
+    return get_inference_data_SAGE(config)
 
 def get_inference_data_graph_batch(config):
     pass
 
 def get_inference_loader_SAGE(infer_data:Data, config:dict):
-    model_config = config["model_config"]
-    num_neighbors = model_config.get("num_neighbors", -1)
-    if type(num_neighbors) == int:
-        num_neighbors = [num_neighbors] * model_config["num_layers"]
-    elif type(num_neighbors) == list:
-        num_neighbors = num_neighbors
-        assert len(num_neighbors) == model_config["num_layers"]
-
     params = config["hyperparameters"]
     
     general_config = config["general_config"]
@@ -300,14 +554,11 @@ def get_inference_loader_SAGE(infer_data:Data, config:dict):
     logger.info(
         f"\ninference_data={infer_data}")
 
-    if not general_config["sample_when_predict"]:
-        logger.warning(
-            "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
-        num_neighbors = [-1] * model_config["num_layers"]
-
-    infer_loader = NeighborLoader(
+    infer_loader = get_neighbor_loader(
         infer_data,
-        num_neighbors=num_neighbors.copy(),
+        num_neighbors=get_num_neighbors(config, predict=True),
+        samplers={},
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=params["batch_size"],
         input_nodes=infer_data.infer_mask,
         num_workers=general_config["num_workers"],
@@ -316,8 +567,9 @@ def get_inference_loader_SAGE(infer_data:Data, config:dict):
 
     return infer_data, infer_loader
 
-def get_inference_loader_SAINT(data:Data, config:dict):
-    pass
+def get_inference_loader_SAINT(infer_data:Data, config:dict):
+    # GraphSAINT is a training sampler; prediction uses node-wise neighborhoods.
+    return get_inference_loader_SAGE(infer_data, config)
 
 def get_inference_loader_no_sampling(infer_data:Data, config:dict):
     model_config = config["model_config"]
@@ -333,9 +585,11 @@ def get_inference_loader_no_sampling(infer_data:Data, config:dict):
             "sample_when_predict is set to be False. All neighbors will be used for aggregation when doing prediction in validation and testing.")
         num_neighbors = [-1] * model_config["num_layers"]
 
-    infer_loader = NeighborLoader(
+    infer_loader = get_neighbor_loader(
         infer_data,
         num_neighbors=num_neighbors.copy(),
+        samplers={},
+        feature_cache_size=get_general_option(config, "feature_cache_size"),
         batch_size=infer_data.num_nodes,
         input_nodes=infer_data.infer_mask,
         num_workers=general_config["num_workers"],
@@ -355,6 +609,9 @@ def get_inference_loader(config):
         return get_inference_loader_SAGE(get_inference_data_SAGE(config), config)
     elif sampling_strategy == 'SAINT':
         return get_inference_loader_SAINT(get_inference_data_SAINT(config), config)
+    elif sampling_strategy == 'Cluster':
+        # Cluster-GCN is a training strategy; prediction uses node-wise neighborhoods.
+        return get_inference_loader_SAGE(get_inference_data_SAGE(config), config)
     elif sampling_strategy == 'GraphBatching':
         return get_inference_loader_graph_batch(get_inference_data_graph_batch(config), config)
     elif sampling_strategy == 'None' or sampling_strategy == None:
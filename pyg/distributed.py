@@ -0,0 +1,98 @@
+import os
+import sys
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from contextlib import contextmanager
+from loguru import logger
+from torch_geometric import seed_everything
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+@contextmanager
+def main_process_first():
+    """Run the block on the main process before the others, e.g. to build the caches only once."""
+    if is_distributed() and get_rank() != 0:
+        dist.barrier()
+    yield
+    if is_distributed() and get_rank() == 0:
+        dist.barrier()
+
+
+def shard_seed_nodes(input_nodes):
+    """Disjoint shard of the seed nodes (mask or indices) for this process.
+
+    Shards are padded by wrapping around like torch's DistributedSampler, so that
+    every process runs the same number of steps and gradient allreduces.
+    """
+    if not is_distributed():
+        return input_nodes
+    if input_nodes.dtype == torch.bool:
+        input_nodes = input_nodes.nonzero().view(-1)
+    world_size = get_world_size()
+    total_size = -(-input_nodes.numel() // world_size) * world_size
+    input_nodes = torch.cat([input_nodes, input_nodes[:total_size - input_nodes.numel()]])
+    return input_nodes[get_rank()::world_size]
+
+
+def all_reduce_sum(tensor):
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def broadcast_object(obj, src=0):
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch(train_fn, config, nprocs):
+    """Run `train_fn(config)` in `nprocs` processes forming a gloo process group."""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(find_free_port()))
+    # Class attributes such as __dict__ of the config class cannot be sent to the spawned processes.
+    config = {key: value for key, value in config.items() if not key.startswith("__")}
+    logger.info(f"Launching {nprocs} training processes.")
+    mp.spawn(_worker, args=(train_fn, config, nprocs), nprocs=nprocs, join=True)
+
+
+def _worker(rank, train_fn, config, nprocs):
+    dist.init_process_group("gloo", rank=rank, world_size=nprocs)
+
+    # Split the cores between the processes instead of oversubscribing them.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // nprocs))
+
+    logger.remove()
+    if rank == 0:
+        logger.add(sys.stderr, level="INFO")
+        logger.add(os.path.join("logs", "log_{time:YYYY-MM-DD-HH_mm}.txt"), rotation='10 MB')
+    else:
+        logger.add(sys.stderr, level="WARNING")
+
+    # Different sampling randomness per process. DDP broadcasts the initial weights of rank 0.
+    seed_everything(config["general_config"]["seed"] + rank)
+
+    try:
+        train_fn(config)
+    finally:
+        dist.destroy_process_group()
@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import torch
+
+from mlflow import MlflowClient
+from loguru import logger
+
+from .data_cache import get_cache_dir, get_split_graph, make_tmp_dir, publish_dir
+from .data_utils import get_transform
+from .train_utils import get_general_option
+
+
+EMBEDDING_CACHE_VERSION = 1
+# numpy has no bfloat16, so bf16 embeddings are stored as raw 16-bit words.
+STORAGE_DTYPES = {torch.float32: np.float32, torch.float16: np.float16, torch.bfloat16: np.int16}
+
+
+def get_embedding_cache_key(config, model_name, version, split):
+    """Everything that changes the layer-wise embeddings of the graph of `split`.
+
+    The MLflow run of the registered model version guards against a version
+    number reused by a re-registered model, and the data cache directory
+    carries the hash of the preprocessed dataset. Returns None without the
+    data cache, as the dataset then has no hash.
+    """
+    if not get_general_option(config, "data_cache", True):
+        return None
+    data_cache_dir = get_cache_dir(config, get_transform(config))
+    return {
+        "version": EMBEDDING_CACHE_VERSION,
+        "model": model_name,
+        "model_version": int(version),
+        "run_id": MlflowClient().get_model_version(model_name, str(version)).run_id,
+        "data": os.path.basename(data_cache_dir),
+        "graph": get_split_graph(data_cache_dir, split),
+        "precision": get_general_option(config, "precision", "fp32"),
+    }
+
+
+def get_embedding_cache_dir(config, key):
+    """Embeddings are cached next to the data cache, per model version, graph and precision."""
+    return os.path.join(
+        f"{get_cache_dir(config, get_transform(config))}-embeddings",
+        f"{key['model']}-v{key['model_version']}",
+        f"{key['graph']}-{key['precision']}",
+    )
+
+
+class EmbeddingCacheWriter:
+    """Write the embeddings of each layer straight into memory-mapped files.
+
+    `alloc` is handed to `layerwise_embeddings`, so the layers are filled in
+    place instead of being held in memory. The cache is written to a
+    temporary directory of its own and moved into place on `close`, so an
+    interrupted run never leaves a partial cache behind, and concurrent runs
+    never write into the same directory.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.tmp_dir = make_tmp_dir(cache_dir)
+        self.layers = []
+        self.arrays = []
+
+    def alloc(self, i, shape, dtype):
+        array = np.lib.format.open_memmap(
+            os.path.join(self.tmp_dir, f"layer{i}.npy"), mode="w+", dtype=STORAGE_DTYPES[dtype], shape=shape)
+        self.layers.append({"file": f"layer{i}.npy", "dtype": str(dtype).removeprefix("torch.")})
+        self.arrays.append(array)
+        return torch.from_numpy(array).view(dtype)
+
+    def close(self, outputs=None):
+        """Publish the cache, with the outputs if they are not the last layer (jumping knowledge)."""
+        for array in self.arrays:
+            array.flush()
+        if outputs is not None:
+            np.save(os.path.join(self.tmp_dir, "outputs.npy"), outputs.numpy())
+        with open(os.path.join(self.tmp_dir, "meta.json"), "w") as out_file:
+            json.dump({"key": self.key, "layers": self.layers, "outputs": outputs is not None}, out_file, indent=2)
+
+        if os.path.exists(self.cache_dir) and get_cached_key(self.cache_dir) != self.key:
+            # Move the stale cache aside before deleting it, so that the path is freed in one step.
+            stale_dir = make_tmp_dir(self.cache_dir)
+            try:
+                os.replace(self.cache_dir, stale_dir)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(stale_dir)
+        if publish_dir(self.tmp_dir, self.cache_dir):
+            logger.info(f"Layer-wise embeddings are cached at {self.cache_dir}")
+        else:
+            logger.info(f"Layer-wise embeddings were already cached at {self.cache_dir} by another run")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def get_cached_key(cache_dir):
+    """Key of the embeddings cached at `cache_dir`, or None if none are."""
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as in_file:
+        return json.load(in_file)["key"]
+
+
+def load_embedding_cache(cache_dir, key):
+    """Memory-mapped embeddings of every layer and the outputs, or None if not cached for `key`."""
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as in_file:
+        meta = json.load(in_file)
+    if meta["key"] != key:
+        logger.warning(f"Cached embeddings at {cache_dir} are stale (model run or dataset changed) and are recomputed.")
+        return None
+
+    xs = []
+    for layer in meta["layers"]:
+        # Copy-on-write memory map, so that rows are paged in on demand and can be updated in memory.
+        x = torch.from_numpy(np.load(os.path.join(cache_dir, layer["file"]), mmap_mode="c"))
+        xs.append(x.view(getattr(torch, layer["dtype"])))
+    outputs = torch.from_numpy(np.load(os.path.join(cache_dir, "outputs.npy"), mmap_mode="c")) if meta["outputs"] else xs[-1]
+
+    logger.info(f"Loaded layer-wise embeddings from {cache_dir}")
+    return xs, outputs
@@ -1,47 +1,55 @@
-import torch
 import os
 
-from .data_utils import get_loader
+from .data_utils import get_loader, get_seed_nodes, get_graph
+from .inference import get_layerwise_outputs
+from .prefetch import PrefetchLoader
+from .train_utils import use_layerwise_inference, get_autocast, get_general_option
 
 from mlflow import MlflowClient
 from mlflow.pytorch import load_model as load_pyt_model
 
+from metrics import MetricAccumulator
+from compile_utils import compile_model
+
 from loguru import logger
 from tqdm import tqdm
-from sklearn.metrics import classification_report
 
 
-def eval(model, loader, enable_tqdm, sampling_strategy, device="cpu", multilabel=False, threshold=0):
-    predictions = []
-    truths = []
+def eval(model, loader, enable_tqdm, sampling_strategy, num_classes, device="cpu", multilabel=False, threshold=0, split="test", precision="fp32", prefetch_batches=2):
+    metrics = MetricAccumulator(num_classes, multilabel=multilabel)
+    loader = PrefetchLoader(loader, split, sampling_strategy, device=device, precision=precision, num_batches=prefetch_batches)
     bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
 
-    for batch in bar:
-        if sampling_strategy in ["SAGE", None, "None"]:
-            mask = torch.arange(batch.batch_size)
-        elif sampling_strategy in ["GraphBatching"]:
-            mask = torch.ones(batch.x.shape[0], dtype=bool)
-            
-        targets = batch.y[mask] # on cpu
-        outputs = model(batch.x.to(device), batch.edge_index.to(device))[mask]
+    for batch, x, edge_index, mask, targets in bar:
+        with get_autocast(device, precision):
+            outputs = model(x, edge_index)[mask]
         
         if multilabel:
             preds = outputs > threshold
         else:
             preds = outputs.argmax(dim=-1)
             
-        predictions.append(preds)
-        truths.append(targets)
-        
-    # Metrics
-    predictions = torch.cat(predictions, dim=0).detach().cpu().numpy()
-    truths = torch.cat(truths, dim=0).detach().numpy()
-    
-    return classification_report(
-        truths, predictions, zero_division=0
-    )
+        metrics.update(preds.detach(), targets)
+
+    return metrics.report()
     
 
+def eval_layerwise(outputs, loader, split, num_classes, multilabel=False, threshold=0):
+    """Report on the nodes of `split` in `loader` given precomputed full-graph outputs."""
+    n_ids = get_seed_nodes(loader, split)
+    targets = loader.data.y[n_ids]
+    outputs = outputs[n_ids].float()
+
+    if multilabel:
+        preds = outputs > threshold
+    else:
+        preds = outputs.argmax(dim=-1)
+
+    metrics = MetricAccumulator(num_classes, multilabel=multilabel)
+    metrics.update(preds, targets)
+    return metrics.report()
+
+
 def overwrite_model_config(model, config):
     config.update(model.config)
 
@@ -70,16 +78,36 @@ def eval_gnn(config):
     dataset_config = config["dataset_config"]
 
     train_loader, val_loader, test_loader = get_loader(config)
+    multilabel = True if dataset_config["task_type"].startswith("multi") else False
+    precision = get_general_option(config, "precision", "fp32")
+    layerwise = use_layerwise_inference(config, model)
+    if layerwise:
+        logger.info("Using layer-wise full-graph inference.")
+        # Splits sharing one graph (transductive) share one layer-wise pass.
+        outputs = {}
 
+    step_model = compile_model(model, get_general_option(config, "compile", False))
     reports = {}
     for split, loader in zip(["train", "val", "test"], [train_loader, val_loader, test_loader]):
+        if layerwise:
+            data = get_graph(loader)
+            if id(data) not in outputs:
+                _, outputs[id(data)] = get_layerwise_outputs(model, data, split, config, model_name, version)
+            reports[split] = eval_layerwise(
+                outputs[id(data)], loader, split, num_classes=dataset_config["num_classes"], multilabel=multilabel)
+            continue
+
         reports[split] = eval(
-            model,
+            step_model,
             loader,
             enable_tqdm=general_config["tqdm"],
             sampling_strategy=general_config["sampling_strategy"],
+            num_classes=dataset_config["num_classes"],
             device=general_config["device"],
-            multilabel= True if dataset_config["task_type"].startswith("multi") else False
+            multilabel=multilabel,
+            split=split,
+            precision=precision,
+            prefetch_batches=get_general_option(config, "prefetch_batches", 2),
         )
     
     # Save report
@@ -0,0 +1,235 @@
+import torch
+
+from torch_geometric.data import Data
+
+from .inference import get_layerwise_outputs
+from .train_utils import get_autocast, get_input_features, get_general_option
+
+from loguru import logger
+
+
+class AppendableTensor:
+    """Rows of `base` followed by rows appended to a buffer of doubling capacity.
+
+    Appending copies only the new rows (amortized), so `base` (e.g. the
+    memory-mapped features of the data cache) is never copied. Rows are read
+    and written with index tensors.
+    """
+
+    def __init__(self, base: torch.Tensor):
+        self.base = base
+        self.buffer = base.new_empty((0, *base.shape[1:]))
+        self.num_appended = 0
+
+    def __len__(self):
+        return self.base.shape[0] + self.num_appended
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    @property
+    def appended(self):
+        return self.buffer[:self.num_appended]
+
+    def append(self, values):
+        size = self.num_appended + values.shape[0]
+        if size > self.buffer.shape[0]:
+            buffer = self.base.new_empty((max(size, 2 * self.buffer.shape[0]), *self.base.shape[1:]))
+            buffer[:self.num_appended] = self.appended
+            self.buffer = buffer
+        self.buffer[self.num_appended:size] = values
+        self.num_appended = size
+
+    def __getitem__(self, index):
+        in_base = index < self.base.shape[0]
+        out = self.base.new_empty((index.numel(), *self.base.shape[1:]))
+        out[in_base] = self.base[index[in_base]]
+        out[~in_base] = self.buffer[index[~in_base] - self.base.shape[0]]
+        return out
+
+    def __setitem__(self, index, values):
+        in_base = index < self.base.shape[0]
+        self.base[index[in_base]] = values[in_base]
+        self.buffer[index[~in_base] - self.base.shape[0]] = values[~in_base]
+
+
+def to_csr(index, other, num_nodes):
+    """Pointer and neighbors of the nodes in `index`, with `other` as the other end of each edge."""
+    if not bool((index[1:] >= index[:-1]).all()):
+        perm = torch.argsort(index, stable=True)
+        index, other = index[perm], other[perm]
+    ptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    ptr[1:] = torch.bincount(index, minlength=num_nodes).cumsum(0)
+    return ptr, other
+
+
+def gather_csr(ptr, neighbors, nodes):
+    """Neighbors of `nodes` in a CSR, with the position in `nodes` of each of them."""
+    # Nodes appended after the CSR was built have no edges in it.
+    keep = (nodes < ptr.shape[0] - 1).nonzero().view(-1)
+    start, count = ptr[nodes[keep]], ptr[nodes[keep] + 1] - ptr[nodes[keep]]
+    pos = torch.repeat_interleave(torch.arange(keep.numel()), count)
+    offsets = torch.arange(pos.numel()) - (count.cumsum(0) - count)[pos]
+    return neighbors[start[pos] + offsets], keep[pos]
+
+
+class IncrementalGraph:
+    """Graph growing by appended nodes and edges, with in- and out-neighbor lookups.
+
+    The edges are kept as CSR over the sources and over the destinations of the
+    base graph, plus a list of appended edges that is scanned by the lookups.
+    The CSRs are rebuilt once the appended edges outnumber `compact_ratio`
+    times the base edges, so the lookup and update cost stays proportional to
+    the size of the updates (amortized).
+    """
+
+    def __init__(self, edge_index, num_nodes, compact_ratio=0.1):
+        self.compact_ratio = compact_ratio
+        self.num_nodes = num_nodes
+        self.delta = AppendableTensor(torch.empty((0, 2), dtype=torch.long))
+        self._build(edge_index[0], edge_index[1])
+
+    def _build(self, src, dst):
+        self.num_base_nodes = self.num_nodes
+        self.num_base_edges = src.numel()
+        self.out_ptr, self.out_dst = to_csr(src, dst, self.num_nodes)
+        self.in_ptr, self.in_src = to_csr(dst, src, self.num_nodes)
+
+    @property
+    def num_edges(self):
+        return self.num_base_edges + len(self.delta)
+
+    def add(self, edge_index, num_nodes):
+        self.num_nodes = num_nodes
+        self.delta.append(edge_index.t())
+        if len(self.delta) > self.compact_ratio * self.num_base_edges:
+            self.compact()
+
+    def compact(self):
+        dst = torch.repeat_interleave(torch.arange(self.num_base_nodes), self.in_ptr.diff())
+        delta = self.delta.appended
+        self._build(torch.cat([self.in_src, delta[:, 0]]), torch.cat([dst, delta[:, 1]]))
+        self.delta = AppendableTensor(torch.empty((0, 2), dtype=torch.long))
+
+    def out_neighbors(self, nodes):
+        dst, _ = gather_csr(self.out_ptr, self.out_dst, nodes)
+        delta = self.delta.appended
+        return torch.cat([dst, delta[torch.isin(delta[:, 0], nodes), 1]])
+
+    def in_edges(self, nodes):
+        """Sources of the edges into the sorted `nodes`, with the position in `nodes` of their destination."""
+        src, pos = gather_csr(self.in_ptr, self.in_src, nodes)
+        delta = self.delta.appended
+        delta = delta[torch.isin(delta[:, 1], nodes)]
+        return torch.cat([src, delta[:, 0]]), torch.cat([pos, torch.searchsorted(nodes, delta[:, 1].contiguous())])
+
+
+class IncrementalInference:
+    """Score a graph that grows by appended nodes and edges, without recomputing it.
+
+    Starts from the embeddings `xs` of every layer and the `outputs` of the
+    whole graph (see `get_layerwise_outputs`). `update` appends nodes (with
+    their features) and edges, and only recomputes the embeddings changed by
+    them: the layer-1 embeddings of the new nodes and of the destinations of
+    the new edges, then at each next layer those of the out-neighbors of the
+    nodes changed by the previous one, i.e. the k-hop frontier of the update
+    for a k-layer model. Each changed embedding is recomputed from the
+    (cached) embeddings of all its in-neighbors, so the outputs are those of a
+    layer-wise pass over the grown graph.
+    """
+
+    def __init__(self, model, data: Data, xs, outputs, device="cpu", precision="fp32", batch_size=1024, compact_ratio=0.1):
+        self.model = model.to(device).eval()
+        self.device = device
+        self.precision = precision
+        self.batch_size = batch_size
+        self.jk = getattr(model, "jk_mode", None) is not None
+
+        self.graph = IncrementalGraph(data.edge_index, data.num_nodes, compact_ratio)
+        self.x = AppendableTensor(data.x)
+        self.embeddings = [AppendableTensor(x) for x in xs]
+        self.outputs = AppendableTensor(outputs) if self.jk else self.embeddings[-1]
+
+    @property
+    def num_nodes(self):
+        return self.graph.num_nodes
+
+    def predict(self, nodes):
+        """Cached outputs of `nodes`."""
+        return self.outputs[torch.as_tensor(nodes, dtype=torch.long).view(-1)].float()
+
+    @torch.no_grad()
+    def update(self, x=None, edge_index=None):
+        """Append nodes with features `x` and edges `edge_index`, and rescore the nodes they affect.
+
+        New nodes get the ids following the current nodes, and `edge_index` may
+        refer to them. Returns the affected nodes and their new outputs.
+        """
+        num_new = 0 if x is None else x.shape[0]
+        if num_new and tuple(x.shape[1:]) != tuple(self.x.base.shape[1:]):
+            raise ValueError(f"Expected features of shape [*, {', '.join(map(str, self.x.base.shape[1:]))}], got {list(x.shape)}.")
+        edge_index = torch.empty((2, 0), dtype=torch.long) if edge_index is None else edge_index.long()
+        num_nodes = self.num_nodes + num_new
+        if edge_index.numel() and (edge_index.min() < 0 or edge_index.max() >= num_nodes):
+            raise ValueError(f"Edges must connect nodes in [0, {num_nodes}).")
+
+        new_nodes = torch.arange(self.num_nodes, num_nodes)
+        if num_new:
+            self.x.append(x.to(self.x.dtype))
+            for embedding in self.embeddings:
+                embedding.append(embedding.base.new_empty((num_new, *embedding.base.shape[1:])))
+            if self.jk:
+                self.outputs.append(self.outputs.base.new_empty((num_new, *self.outputs.base.shape[1:])))
+        self.graph.add(edge_index, num_nodes)
+
+        # Layer-1 embeddings change for the new nodes and the destinations of new edges.
+        frontier = torch.unique(torch.cat([new_nodes, edge_index[1]]))
+        for i in range(self.model.num_layers):
+            if i > 0:
+                frontier = torch.unique(torch.cat([frontier, self.graph.out_neighbors(frontier)]))
+            h = self.x if i == 0 else self.embeddings[i - 1]
+            for nodes in frontier.split(self.batch_size):
+                self.embeddings[i][nodes] = self.layer_forward(i, h, nodes)
+
+        if self.jk:
+            for nodes in frontier.split(self.batch_size):
+                with get_autocast(self.device, self.precision):
+                    self.outputs[nodes] = self.model.jk_readout(
+                        [embedding[nodes].to(self.device) for embedding in self.embeddings]).float().cpu()
+
+        logger.debug(f"Appended {num_new} nodes and {edge_index.shape[1]} edges, rescored {frontier.numel()} nodes.")
+        return frontier, self.outputs[frontier].float()
+
+    def layer_forward(self, i, h, nodes):
+        """Embeddings of the sorted `nodes` at layer i, from the embeddings `h` of the previous layer."""
+        src, pos = self.graph.in_edges(nodes)
+        n_id, inverse = torch.unique(torch.cat([nodes, src]), return_inverse=True)
+        edge_index = torch.stack([inverse[nodes.numel():], inverse[pos]])
+        with get_autocast(self.device, self.precision):
+            out = self.model.layer_forward(
+                i, get_input_features(h[n_id], self.device, self.precision), edge_index.to(self.device))
+        return out[inverse[:nodes.numel()]].cpu()
+
+
+def get_incremental_inference(model, data: Data, config, split=None, model_name=None, version=None):
+    """IncrementalInference of a model supporting layer-wise inference, over the whole graph `data`.
+
+    The embeddings of a registered model (`model_name`, `version`) on the graph
+    of `split` are read from the embedding cache, and computed otherwise.
+    Updates are applied to copy-on-write maps of the cached embeddings and
+    never written back.
+    """
+    if not getattr(model, "supports_layerwise_inference", False):
+        raise ValueError(f"Incremental inference requires layer-wise inference, which {type(model).__name__} does not support.")
+    xs, outputs = get_layerwise_outputs(model, data, split, config, model_name, version, keep_layers=True)
+    return IncrementalInference(
+        model,
+        data,
+        xs,
+        outputs,
+        device=config["general_config"]["device"],
+        precision=get_general_option(config, "precision", "fp32"),
+        batch_size=config["hyperparameters"]["batch_size"],
+        compact_ratio=get_general_option(config, "incremental_compact_ratio", 0.1),
+    )
@@ -1,50 +1,152 @@
 import torch
 import os
 
-import numpy as np
-import pandas as pd
 
-from .data_utils import get_inference_loader
+from .data_utils import get_inference_loader, get_layerwise_loader
+from .embedding_cache import get_embedding_cache_key, get_embedding_cache_dir, EmbeddingCacheWriter, load_embedding_cache
+from .prefetch import PrefetchLoader
+from .train_utils import use_layerwise_inference, get_autocast, get_input_features, get_general_option
 
 from mlflow import MlflowClient
 from mlflow.pytorch import load_model as load_pyt_model
 
+from compile_utils import compile_model
+from prediction_writer import PredictionWriter, get_prediction_path
+
 from loguru import logger
 from tqdm import tqdm
 
 
-def inference(model, loader, enable_tqdm, sampling_strategy, device="cpu", multilabel=False, threshold=0):
-    n_ids = []
-    predictions = []
+@torch.no_grad()
+def layerwise_embeddings(model, data, loader, enable_tqdm=False, device="cpu", precision="fp32", keep_layers=False, alloc=None):
+    """Compute the embeddings of all nodes in `data` one layer at a time.
+
+    `loader` yields the full 1-hop neighborhoods of all nodes (see
+    `get_layerwise_loader`), so every layer touches each edge exactly once
+    instead of re-expanding the k-hop neighborhood of every seed batch.
+    With precision "bf16", the intermediate embeddings are also kept in bf16.
+    Returns the embeddings of every layer if `keep_layers` or for jumping
+    knowledge, otherwise only those of the last layer. `alloc(i, shape, dtype)`
+    may provide the output tensor of layer i, e.g. a memory-mapped file.
+    """
+    model.eval()
+    keep_layers = keep_layers or getattr(model, "jk_mode", None) is not None
+
+    x_all = data.x
+    xs = []
+    for i in range(model.num_layers):
+        x_next = None
+        bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
+        bar.set_description(f"layer {i+1}/{model.num_layers}")
+        for batch in bar:
+            n_id = batch.n_id
+            with get_autocast(device, precision):
+                out = model.layer_forward(
+                    i, get_input_features(x_all[n_id], device, precision), batch.edge_index.to(device))[:batch.batch_size]
+            if x_next is None:
+                shape = (data.num_nodes, out.shape[-1])
+                x_next = torch.empty(shape, dtype=out.dtype) if alloc is None else alloc(i, shape, out.dtype)
+            x_next[n_id[:batch.batch_size]] = out.cpu()
+        x_all = x_next
+        if keep_layers:
+            xs.append(x_all)
+
+    return xs if keep_layers else [x_all]
+
+
+@torch.no_grad()
+def jk_readout(model, xs, chunk_size, device="cpu", precision="fp32"):
+    """Jumping knowledge readout of the per-layer embeddings, `chunk_size` nodes at a time."""
+    outputs = []
+    for start in range(0, xs[0].shape[0], chunk_size):
+        with get_autocast(device, precision):
+            outputs.append(model.jk_readout(
+                [x[start:start+chunk_size].to(device) for x in xs]).float().cpu())
+    return torch.cat(outputs, dim=0)
+
+
+@torch.no_grad()
+def layerwise_inference(model, data, loader, enable_tqdm=False, device="cpu", precision="fp32"):
+    """Compute the outputs of all nodes in `data` one layer at a time (see `layerwise_embeddings`)."""
+    xs = layerwise_embeddings(model, data, loader, enable_tqdm=enable_tqdm, device=device, precision=precision)
+    if getattr(model, "jk_mode", None) is None:
+        return xs[-1].float()
+    # Jumping knowledge readout, chunked like the layers.
+    return jk_readout(model, xs, loader.batch_size, device=device, precision=precision)
+
+
+def get_layerwise_outputs(model, data, split, config, model_name=None, version=None, keep_layers=False):
+    """Per-layer embeddings and outputs of all nodes in `data`, the graph of `split`, computed layer by layer.
+
+    For a registered model, every layer is cached on disk (memory-mapped) under
+    its model version and the hash of the dataset, and shared by evaluation,
+    inference and incremental inference. Any split of the graph is then
+    scored by gathering its rows of the outputs. Returns the embeddings of
+    every layer (only the last one without the cache unless `keep_layers`)
+    and the outputs.
+    """
+    device = config["general_config"]["device"]
+    precision = get_general_option(config, "precision", "fp32")
+    enable_tqdm = get_general_option(config, "tqdm", False)
+    batch_size = config["hyperparameters"]["batch_size"]
+    jk = getattr(model, "jk_mode", None) is not None
+
+    key = None
+    if model_name is not None and get_general_option(config, "embedding_cache", True):
+        key = get_embedding_cache_key(config, model_name, version, split)
+    if key is None:
+        xs = layerwise_embeddings(
+            model, data, get_layerwise_loader(data, config), enable_tqdm=enable_tqdm, device=device, precision=precision,
+            keep_layers=keep_layers)
+        return xs, jk_readout(model, xs, batch_size, device=device, precision=precision) if jk else xs[-1]
+
+    cache_dir = get_embedding_cache_dir(config, key)
+    cached = load_embedding_cache(cache_dir, key)
+    if cached is not None:
+        return cached
+
+    with EmbeddingCacheWriter(cache_dir, key) as writer:
+        xs = layerwise_embeddings(
+            model, data, get_layerwise_loader(data, config), enable_tqdm=enable_tqdm, device=device, precision=precision,
+            keep_layers=True, alloc=writer.alloc)
+        writer.close(outputs=jk_readout(model, xs, batch_size, device=device, precision=precision) if jk else None)
+    return load_embedding_cache(cache_dir, key)
+
+
+@torch.no_grad()
+def inference(model, loader, writer, enable_tqdm, sampling_strategy, device="cpu", multilabel=False, threshold=0, precision="fp32", prefetch_batches=2, write_probs=False, labels=None):
+    """Predict the seed nodes of `loader` and stream them to the PredictionWriter `writer`.
+
+    Every batch is written as soon as it is predicted (with the probabilities
+    if `write_probs`, and the truths from `labels` if given), so no
+    predictions are gathered in memory.
+    """
+    loader = PrefetchLoader(loader, "infer", sampling_strategy, device=device, precision=precision, num_batches=prefetch_batches)
     bar = tqdm(loader, total=len(loader), disable=not enable_tqdm)
 
-    for batch in bar:
-        if sampling_strategy in ["SAGE", None, "None"]:
-            mask = torch.arange(batch.batch_size)
+    for batch, x, edge_index, mask, _ in bar:
+        if sampling_strategy in ["SAGE", "SAINT", "Cluster", None, "None"]:
             batch_n_ids = batch.n_id[mask]
         elif sampling_strategy in ["GraphBatching"]:
-            mask = torch.ones(batch.x.shape[0], dtype=bool)
             raise NotImplementedError
         
-        outputs = model(batch.x.to(device), batch.edge_index.to(device))[mask]
+        with get_autocast(device, precision):
+            outputs = model(x, edge_index)[mask]
         
         if multilabel:
             preds = outputs > threshold
         else:
             preds = outputs.argmax(dim=-1)
-        
-        n_ids.append(batch_n_ids)
-        predictions.append(preds)
-        
-    # Metrics
-    n_ids = torch.cat(n_ids, dim=0).detach().numpy()
-    predictions = torch.cat(predictions, dim=0).detach().cpu().numpy()
-    
-    idx = np.argsort(n_ids)
-    n_ids = n_ids[idx]
-    predictions = predictions[idx]
-    
-    return n_ids, predictions
+
+        writer.write(
+            batch_n_ids, preds,
+            probs=get_probabilities(outputs, multilabel) if write_probs else None,
+            truths=labels[batch_n_ids] if labels is not None else None)
+
+
+def get_probabilities(outputs, multilabel=False):
+    outputs = outputs.float()
+    return torch.sigmoid(outputs) if multilabel else torch.softmax(outputs, dim=-1)
     
 
 def overwrite_model_config(model, config):
@@ -75,48 +177,36 @@ def infer_gnn(config):
     dataset_config = config["dataset_config"]
 
     data, loader = get_inference_loader(config)
+    multilabel = True if dataset_config["task_type"].startswith("multi") else False
+    precision = get_general_option(config, "precision", "fp32")
+    labels = data.y if vargs["write_truths"] and vargs["split"] != "unlabelled" and "y" in data else None
 
-    n_ids, predictions = inference(
-        model,
-        loader,
-        enable_tqdm=vargs["tqdm"],
-        sampling_strategy=general_config["sampling_strategy"],
-        device=general_config["device"],
-        multilabel= True if dataset_config["task_type"].startswith("multi") else False
-        )
-    
-    
-    # Save predictions
-    pred_path = os.path.join(
-        vargs["output_dir"],
-        f"{config['model']}-v{version}-{config['dataset']}",
-        f"{vargs['split']}-pred"
-    )+".csv"
-    
-    save_dir = os.path.split(pred_path)[0]
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-        
-    n = n_ids.shape[0]
-    content = np.hstack((n_ids.reshape(n, -1), predictions.reshape(n, -1)))
-    pred_df = pd.DataFrame(content)
-    col_names = ["n_id"]
-    if predictions.ndim > 1:
-        for i in range(predictions.shape[1]):
-            col_names.append(f"pred_{i+1}")
-    else:
-        col_names.append("pred")
-    print(pred_df)
-    pred_df.columns = col_names
-    pred_df.to_csv(pred_path, index=False)
-    
-    truth_path = os.path.join(save_dir, f"{vargs['split']}-truth.csv")
-    
-    content = np.hstack((n_ids.reshape(n, -1), data.y.numpy()[n_ids].reshape(n, -1)))
-    truth_df = pd.DataFrame(content)
-    truth_df.columns = col_names
-    truth_df.to_csv(truth_path, index=False)
-    
-    
-        
-        
\ No newline at end of file
+    # Predictions are streamed to the output file batch by batch
+    pred_path = get_prediction_path(
+        vargs["output_dir"], f"{config['model']}-v{version}-{config['dataset']}", vargs["split"], vargs["output_format"])
+    with PredictionWriter(pred_path, vargs["output_format"]) as writer:
+        if use_layerwise_inference(config, model):
+            logger.info("Using layer-wise full-graph inference.")
+            _, outputs = get_layerwise_outputs(model, data, vargs["split"], config, model_name, version)
+            # Seed nodes come from infer_mask in ascending order.
+            n_ids = data.infer_mask.nonzero().view(-1)
+            for chunk in n_ids.split(config["hyperparameters"]["batch_size"]):
+                chunk_outputs = outputs[chunk].float()
+                writer.write(
+                    chunk, chunk_outputs > 0 if multilabel else chunk_outputs.argmax(dim=-1),
+                    probs=get_probabilities(chunk_outputs, multilabel) if vargs["write_probs"] else None,
+                    truths=labels[chunk] if labels is not None else None)
+        else:
+            inference(
+                compile_model(model, get_general_option(config, "compile", False)),
+                loader,
+                writer,
+                enable_tqdm=vargs["tqdm"],
+                sampling_strategy=general_config["sampling_strategy"],
+                device=general_config["device"],
+                multilabel=multilabel,
+                precision=precision,
+                prefetch_batches=get_general_option(config, "prefetch_batches", 2),
+                write_probs=vargs["write_probs"],
+                labels=labels,
+                )
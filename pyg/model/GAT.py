@@ -9,8 +9,10 @@ from torch_geometric.nn.models import GAT as GAT_Base
 from torch_geometric.nn.models import JumpingKnowledge
 from torch_geometric.nn import GATConv, GATv2Conv
 
+from .layerwise import LayerwiseBasicGNN
 
-class GAT_PyG(GAT_Base):
+
+class GAT_PyG(LayerwiseBasicGNN, GAT_Base):
     def __init__(self, config={}, *arg, **kwargs):
         super().__init__(*arg, **kwargs)
         self.config = config
@@ -116,3 +118,20 @@ class GAT_Custom(torch.nn.Module):
             x = self.jk(xs)
             x = self.jk_linear(x)
         return x
+
+    @property
+    def supports_layerwise_inference(self):
+        return True
+
+    def layer_forward(self, i, x, edge_index):
+        """Apply the i-th layer in eval mode, as done in `forward`."""
+        if self.skip_connection:
+            residual = self.skip_proj[i](x)
+        x = self.conv[i](x, edge_index)
+        x = x + residual if self.skip_connection else x
+        return F.elu(x)
+
+    def jk_readout(self, xs):
+        if self.jk_mode == None:
+            return xs[-1]
+        return self.jk_linear(self.jk(xs))
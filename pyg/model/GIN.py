@@ -0,0 +1,98 @@
+import torch
+import torch.nn.functional as F
+
+from torch.nn import Linear, ModuleList, Sequential, Dropout
+
+from torch_geometric.nn import GINConv
+
+from fused_layers import LinearBNReLU
+
+
+def to_adj_t(edge_index, num_nodes):
+    """Transposed adjacency (destination x source) as a torch CSR tensor.
+
+    Sum aggregation over it is a single sparse-dense matrix multiplication.
+    Duplicate edges are kept, so that they are summed as in message passing.
+    """
+    row, col = edge_index
+    if col.numel() > 1 and not bool((col[1:] >= col[:-1]).all()):
+        perm = torch.argsort(col, stable=True)
+        row, col = row[perm], col[perm]
+    crow = torch.zeros(num_nodes + 1, dtype=torch.long, device=col.device)
+    crow[1:] = torch.bincount(col, minlength=num_nodes).cumsum(0)
+    return torch.sparse_csr_tensor(crow, row, torch.ones(row.numel(), device=row.device), size=(num_nodes, num_nodes))
+
+
+class GIN_PyG(torch.nn.Module):
+    """GIN for node classification, the PyG counterpart of `GIN_DGL_Custom`.
+
+    Each layer sums the features of the neighbors with (1 + eps) times the own
+    features and applies an MLP of `num_lin_layers` linear layers, each
+    followed by batch norm and ReLU (the last one being the norm and activation
+    of the layer). Two linear layers predict the classes from the last layer.
+    """
+
+    def __init__(self,
+                 in_channels,
+                 hidden_channels: int,
+                 num_layers: int,
+                 out_channels: int,
+                 num_lin_layers: int = 2,
+                 eps: float = 0.,
+                 train_eps: bool = False,
+                 dropout: float = 0.6,
+                 mlp_dropout: float = 0.3,
+                 mlp_bias: bool = True,
+                 sparse_aggr: bool = True,
+                 config={},
+                 **kwargs):
+        super().__init__()
+        self.config = config
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.sparse_aggr = sparse_aggr
+
+        self.convs = ModuleList()
+        for i in range(num_layers):
+            blocks = []
+            for j in range(num_lin_layers):
+                if j > 0:
+                    blocks.append(Dropout(mlp_dropout))
+                blocks.append(LinearBNReLU(in_channels if i == j == 0 else hidden_channels, hidden_channels, bias=mlp_bias))
+            self.convs.append(GINConv(Sequential(*blocks), eps=eps, train_eps=train_eps))
+
+        self.linear1 = Linear(hidden_channels, hidden_channels)
+        self.linear2 = Linear(hidden_channels, out_channels)
+
+    def reset_parameters(self):
+        for conv in self.convs:
+            conv.reset_parameters()
+        self.linear1.reset_parameters()
+        self.linear2.reset_parameters()
+
+    def forward(self, x, edge_index):
+        adj = self.get_adj(x, edge_index)
+        for i in range(self.num_layers):
+            x = self.convs[i](x, adj)
+        return self.predict(x)
+
+    def get_adj(self, x, edge_index):
+        """Adjacency passed to the convolutions: the transposed CSR adjacency if `sparse_aggr`, else `edge_index`."""
+        # Autocast runs sparse CSR products in low precision, which is not implemented everywhere (e.g. bf16 on CPU).
+        if self.sparse_aggr and not torch.is_autocast_enabled(x.device.type):
+            return to_adj_t(edge_index, x.shape[0])
+        return edge_index
+
+    def predict(self, x):
+        x = F.relu(self.linear1(x))
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        return self.linear2(x)
+
+    @property
+    def supports_layerwise_inference(self):
+        return True
+
+    def layer_forward(self, i, x, edge_index):
+        """Apply the i-th layer in eval mode, as done in `forward` (with the prediction head after the last one)."""
+        x = self.convs[i](x, self.get_adj(x, edge_index))
+        return self.predict(x) if i == self.num_layers - 1 else x
@@ -1,9 +1,10 @@
 from loguru import logger
 from torch_geometric.nn.models import GraphSAGE as GraphSAGE_Base
 
+from .layerwise import LayerwiseBasicGNN
 
 
-class GraphSAGE_PyG(GraphSAGE_Base):
+class GraphSAGE_PyG(LayerwiseBasicGNN, GraphSAGE_Base):
     def __init__(self, config={}, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = config
@@ -0,0 +1,29 @@
+class LayerwiseBasicGNN:
+    """Layer-wise inference hooks for models derived from PyG's BasicGNN.
+
+    `layer_forward` mirrors one iteration of `BasicGNN.forward` in eval mode, and
+    `jk_readout` applies the jumping knowledge and output projection (if any) on
+    the per-layer embeddings.
+    """
+
+    @property
+    def supports_layerwise_inference(self):
+        # Batch-aware norms (e.g., GraphNorm) cannot be evaluated chunk by chunk.
+        return not getattr(self, "supports_norm_batch", False)
+
+    def layer_forward(self, i, x, edge_index):
+        x = self.convs[i](x, edge_index)
+        if i < self.num_layers - 1 or self.jk_mode is not None:
+            if self.act is not None and self.act_first:
+                x = self.act(x)
+            if self.norms is not None:
+                x = self.norms[i](x)
+            if self.act is not None and not self.act_first:
+                x = self.act(x)
+            # Dropout is the identity in eval mode.
+        return x
+
+    def jk_readout(self, xs):
+        x = self.jk(xs) if hasattr(self, "jk") else xs[-1]
+        x = self.lin(x) if hasattr(self, "lin") else x
+        return x
@@ -0,0 +1,122 @@
+import torch
+
+from torch.utils.data import DataLoader as TorchDataLoader
+from torch_geometric.loader import NodeLoader
+from loguru import logger
+
+
+class MultiplexedLoader:
+    """One pool of sampler workers shared by the node loaders of several splits.
+
+    The split loaders only provide their index batches and sampling functions;
+    batches are sampled by the workers of a single DataLoader, in the order of a
+    plan of (split, indices) requests. When a split is iterated, the batches of
+    the split that usually follows it (`follow`, e.g. val after train) are
+    planned right after, so the workers start sampling them while the last
+    batches of the first split are still being consumed. Planned batches that
+    are not consumed are dropped when another split is requested.
+    """
+
+    def __init__(self, loaders: dict, follow=None, num_workers=1, persistent_workers=True, prefetch_factor=2):
+        self.loaders = loaders
+        self.follow = follow or {}
+        self.plan = []
+        self.position = 0
+        self.iterator = None
+        self.dataloader = TorchDataLoader(
+            _Requests(),
+            batch_size=None,
+            sampler=_PlanSampler(self),
+            collate_fn=_Sample(loaders),
+            num_workers=num_workers,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+        )
+
+    def iterate(self, split):
+        if self.position >= len(self.plan) or self.plan[self.position][0] != split or not self._at_split_start():
+            self._start(split)
+
+        loader = self.loaders[split]
+        while self.position < len(self.plan) and self.plan[self.position][0] == split:
+            self.position += 1
+            _, out = next(self.iterator)
+            if not loader.filter_per_worker:
+                out = loader.filter_fn(out)
+            yield out
+
+    def _at_split_start(self):
+        return self.position == 0 or self.plan[self.position - 1][0] != self.plan[self.position][0]
+
+    def _start(self, split):
+        self.plan = []
+        while split is not None and all(name != split for name, _ in self.plan):
+            self.plan.extend((split, indices) for indices in self.loaders[split].batch_sampler)
+            split = self.follow.get(split)
+        self.position = 0
+        # Resets the persistent workers, discarding batches planned but not consumed.
+        self.iterator = iter(self.dataloader)
+
+
+class SplitLoader:
+    """Loader of one split of a MultiplexedLoader. Other attributes come from the split's own loader."""
+
+    def __init__(self, pool: MultiplexedLoader, split, loader: NodeLoader):
+        self.pool = pool
+        self.split = split
+        self.loader = loader
+
+    def __iter__(self):
+        return self.pool.iterate(self.split)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class _Requests(torch.utils.data.Dataset):
+    def __getitem__(self, request):
+        return request
+
+
+class _PlanSampler(torch.utils.data.Sampler):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __iter__(self):
+        return iter(self.pool.plan)
+
+    def __len__(self):
+        return len(self.pool.plan)
+
+
+class _Sample:
+    def __init__(self, loaders):
+        self.loaders = loaders
+
+    def __call__(self, request):
+        split, indices = request
+        return split, self.loaders[split].collate_fn(indices)
+
+
+def multiplex_loaders(train_loader, val_loader, test_loader):
+    """Share one worker pool between the train, val and test loaders (which keep their own settings otherwise).
+
+    The split loaders never start their own workers. Returns the loaders
+    unchanged if they do not use workers.
+    """
+    if train_loader.num_workers == 0:
+        return train_loader, val_loader, test_loader
+
+    logger.info(f"Sharing {train_loader.num_workers} loader workers between the train, val and test loaders.")
+    loaders = {"train": train_loader, "val": val_loader, "test": test_loader}
+    pool = MultiplexedLoader(
+        loaders,
+        follow={"train": "val"},
+        num_workers=train_loader.num_workers,
+        persistent_workers=train_loader.persistent_workers,
+        prefetch_factor=train_loader.prefetch_factor,
+    )
+    return tuple(SplitLoader(pool, split, loader) for split, loader in loaders.items())
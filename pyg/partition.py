@@ -0,0 +1,149 @@
+import os
+
+import numpy as np
+import torch
+import torch_geometric.typing
+
+from torch_geometric.data import Data
+from torch_geometric.utils import to_undirected, remove_self_loops, sort_edge_index
+from loguru import logger
+
+
+def to_csr(edge_index, num_nodes):
+    row, col = sort_edge_index(edge_index, num_nodes=num_nodes)
+    rowptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+    rowptr[1:] = torch.bincount(row, minlength=num_nodes).cumsum(0)
+    return rowptr, col
+
+
+def metis_partition(rowptr, col, num_parts):
+    """METIS partition through torch-sparse or pyg-lib. Returns None if neither is available."""
+    if torch_geometric.typing.WITH_TORCH_SPARSE:
+        try:
+            return torch.ops.torch_sparse.partition(rowptr, col, None, num_parts, False)
+        except (AttributeError, RuntimeError):
+            pass
+    if torch_geometric.typing.WITH_METIS:
+        import pyg_lib
+        return pyg_lib.partition.metis(rowptr, col, num_parts)
+    return None
+
+
+def bfs_partition(rowptr, col, num_parts):
+    """Balanced partition of a breadth-first node ordering.
+
+    A locality-preserving fallback when METIS is unavailable: nodes are
+    ordered by a frontier-wise BFS over all connected components, and the
+    ordering is cut into `num_parts` parts of equal size.
+    """
+    rowptr, col = rowptr.numpy(), col.numpy()
+    num_nodes = rowptr.shape[0] - 1
+    deg = np.diff(rowptr)
+
+    visited = deg == 0  # Isolated nodes are appended at the end.
+    order = []
+    next_start = 0
+    while True:
+        while next_start < num_nodes and visited[next_start]:
+            next_start += 1
+        if next_start == num_nodes:
+            break
+
+        frontier = np.array([next_start])
+        visited[next_start] = True
+        while frontier.shape[0] > 0:
+            order.append(frontier)
+            starts, counts = rowptr[frontier], deg[frontier]
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            neighbors = col[offsets + np.arange(counts.sum())]
+            frontier = np.unique(neighbors[~visited[neighbors]])
+            visited[frontier] = True
+
+    order.append(np.flatnonzero(deg == 0))
+    order = np.concatenate(order)
+
+    cluster = np.empty(num_nodes, dtype=np.int64)
+    cluster[order] = np.arange(num_nodes) * num_parts // max(num_nodes, 1)
+    return torch.from_numpy(cluster)
+
+
+def partition_graph(edge_index, num_nodes, num_parts):
+    """Cluster assignment of every node, computed on the undirected graph."""
+    edge_index, _ = remove_self_loops(to_undirected(edge_index, num_nodes=num_nodes))
+    rowptr, col = to_csr(edge_index, num_nodes)
+
+    cluster = metis_partition(rowptr, col, num_parts)
+    if cluster is None:
+        logger.warning("METIS is not available (requires 'torch-sparse' or 'pyg-lib'). Falling back to BFS partitioning.")
+        cluster = bfs_partition(rowptr, col, num_parts)
+    return cluster
+
+
+def get_partition(data: Data, num_parts, save_path):
+    """Partition `data` once and persist the assignment at `save_path`."""
+    if os.path.exists(save_path):
+        logger.info(f"Loaded graph partition from {save_path}")
+        return torch.from_numpy(np.load(save_path))
+
+    logger.info(f"Partitioning the graph into {num_parts} clusters.")
+    cluster = partition_graph(data.edge_index, data.num_nodes, num_parts)
+
+    if not os.path.exists(os.path.dirname(save_path)):
+        os.makedirs(os.path.dirname(save_path))
+    np.save(save_path, cluster.numpy())
+    return cluster
+
+
+class ClusterBatcher:
+    """Collate a list of cluster ids into the subgraph induced by their nodes.
+
+    Nodes are permuted so that every cluster is a contiguous range with its
+    rows of the CSR adjacency, so the cost of a batch only depends on the
+    size of the selected clusters.
+    """
+
+    def __init__(self, data: Data, cluster, num_parts):
+        self.data = data
+        self.num_parts = num_parts
+
+        # perm[new_id] = old_id
+        self.perm = torch.argsort(cluster, stable=True)
+        sizes = torch.bincount(cluster, minlength=num_parts)
+        self.cluster_ptr = torch.zeros(num_parts + 1, dtype=torch.long)
+        self.cluster_ptr[1:] = sizes.cumsum(0)
+        self.cluster = torch.repeat_interleave(torch.arange(num_parts), sizes)
+
+        new_id = torch.empty_like(self.perm)
+        new_id[self.perm] = torch.arange(self.perm.shape[0])
+        self.rowptr, self.col = to_csr(new_id[data.edge_index], data.num_nodes)
+
+    def __call__(self, cluster_ids):
+        cluster_ids = torch.tensor(sorted(cluster_ids), dtype=torch.long)
+        starts = self.cluster_ptr[cluster_ids]
+        sizes = self.cluster_ptr[cluster_ids + 1] - starts
+        num_nodes = int(sizes.sum())
+
+        # Local id of a node = its offset within its cluster + the offset of the cluster in the batch.
+        local_offset = torch.zeros(self.num_parts, dtype=torch.long)
+        local_offset[cluster_ids] = sizes.cumsum(0) - sizes - starts
+        selected = torch.zeros(self.num_parts, dtype=torch.bool)
+        selected[cluster_ids] = True
+
+        nodes = torch.repeat_interleave(starts - sizes.cumsum(0) + sizes, sizes) + torch.arange(num_nodes)
+
+        # Edges of the selected rows, restricted to the selected clusters.
+        edge_starts = self.rowptr[nodes]
+        degs = self.rowptr[nodes + 1] - edge_starts
+        edge_ids = torch.repeat_interleave(edge_starts - degs.cumsum(0) + degs, degs) + torch.arange(int(degs.sum()))
+        row = torch.repeat_interleave(torch.arange(num_nodes), degs)
+        col = self.col[edge_ids]
+        keep = selected[self.cluster[col]]
+        col = col[keep] + local_offset[self.cluster[col[keep]]]
+        row = row[keep]
+
+        n_id = self.perm[nodes]
+        batch = Data(edge_index=torch.stack([row, col]), num_nodes=num_nodes, n_id=n_id)
+        for key, value in self.data.items():
+            if key != "edge_index" and isinstance(value, torch.Tensor) and self.data.is_node_attr(key):
+                batch[key] = value[n_id]
+        return batch
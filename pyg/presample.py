@@ -0,0 +1,199 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader as TorchDataLoader
+from torch_geometric.sampler import SamplerOutput
+from loguru import logger
+
+from .data_cache import get_cache_dir
+from .data_utils import get_transform
+from .distributed import get_rank, get_world_size
+
+
+PRESAMPLE_VERSION = 2
+
+
+def get_presample_dir(config, train_loader):
+    """Everything that changes the sampled batches: graph, seed nodes, fan-out, batch size and seed."""
+    general_config = config["general_config"]
+    key = {
+        "version": PRESAMPLE_VERSION,
+        "data": os.path.basename(get_cache_dir(config, get_transform(config))),
+        "sampling_strategy": general_config["sampling_strategy"],
+        "num_neighbors": repr(train_loader.node_sampler.num_neighbors.values),
+        "batch_size": train_loader.batch_size,
+        "num_seed_nodes": len(train_loader.input_data.node),
+        "seed": general_config["seed"],
+        "num_epochs": general_config["presample_epochs"],
+        "rank": get_rank(),
+        "world_size": get_world_size(),
+    }
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(general_config["presample_dir"], f"{config['dataset']}-{digest}"), key
+
+
+class EpochWriter:
+    """Save the sampler outputs of one epoch as flat arrays with per-batch offsets, batch by batch.
+
+    The per-node and per-edge arrays are appended to raw files as the batches
+    come, so only the offsets and sampled counts of an epoch are held in memory.
+    Their dtypes and shapes are saved in "arrays.json" on `close`.
+    """
+
+    def __init__(self, epoch_dir):
+        os.makedirs(epoch_dir)
+        self.epoch_dir = epoch_dir
+        self.files = {}
+        self.arrays = {}
+        self.counts = {"node_ptr": [], "edge_ptr": [], "input_ptr": []}
+        self.num_sampled_nodes = []
+        self.num_sampled_edges = []
+
+    def write(self, out):
+        self._append("node", out.node)
+        # Local indices into the nodes of the batch.
+        self._append("row", out.row.int())
+        self._append("col", out.col.int())
+        if out.edge is not None:
+            self._append("edge", out.edge)
+        self._append("input_id", out.metadata[0])
+        self.counts["node_ptr"].append(out.node.numel())
+        self.counts["edge_ptr"].append(out.row.numel())
+        self.counts["input_ptr"].append(out.metadata[0].numel())
+        self.num_sampled_nodes.append(out.num_sampled_nodes)
+        self.num_sampled_edges.append(out.num_sampled_edges)
+
+    def _append(self, key, value):
+        value = value.numpy()
+        if key not in self.files:
+            self.files[key] = open(os.path.join(self.epoch_dir, f"{key}.bin"), "wb")
+            self.arrays[key] = {"dtype": value.dtype.str, "shape": [0, *value.shape[1:]]}
+        value.tofile(self.files[key])
+        self.arrays[key]["shape"][0] += value.shape[0]
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        for key, counts in self.counts.items():
+            np.save(os.path.join(self.epoch_dir, f"{key}.npy"), _ptr(counts).numpy())
+        np.save(os.path.join(self.epoch_dir, "num_sampled_nodes.npy"), np.array(self.num_sampled_nodes, dtype=np.int64))
+        np.save(os.path.join(self.epoch_dir, "num_sampled_edges.npy"), np.array(self.num_sampled_edges, dtype=np.int64))
+        with open(os.path.join(self.epoch_dir, "arrays.json"), "w") as out_file:
+            json.dump(self.arrays, out_file, indent=2)
+
+
+def load_epoch(epoch_dir):
+    """Arrays of an epoch saved by EpochWriter, the per-node and per-edge ones memory-mapped."""
+    arrays = {
+        key: torch.from_numpy(np.load(os.path.join(epoch_dir, f"{key}.npy")))
+        for key in ["node_ptr", "edge_ptr", "input_ptr", "num_sampled_nodes", "num_sampled_edges"]
+    }
+    with open(os.path.join(epoch_dir, "arrays.json")) as in_file:
+        meta = json.load(in_file)
+    for key, array in meta.items():
+        dtype, shape = np.dtype(array["dtype"]), tuple(array["shape"])
+        if shape[0] == 0:
+            # Empty files cannot be memory-mapped.
+            arrays[key] = torch.from_numpy(np.empty(shape, dtype=dtype))
+        else:
+            # Copy-on-write memory map, so that batches are paged in on demand.
+            arrays[key] = torch.from_numpy(np.memmap(os.path.join(epoch_dir, f"{key}.bin"), dtype=dtype, mode="c", shape=shape))
+    return arrays
+
+
+def presample(train_loader, save_dir, key, num_epochs, seed):
+    """Sample `num_epochs` epochs of a NeighborLoader once, with a fixed seed, into `save_dir`."""
+    tmp_dir = save_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    node_sampler, input_data = train_loader.node_sampler, train_loader.input_data
+    loader = TorchDataLoader(
+        list(train_loader.batch_sampler),
+        batch_size=None,
+        collate_fn=lambda index: node_sampler.sample_from_nodes(input_data[index]),
+        num_workers=train_loader.num_workers,
+    )
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        for epoch in range(num_epochs):
+            logger.info(f"Pre-sampling epoch {epoch + 1}/{num_epochs}")
+            writer = EpochWriter(os.path.join(tmp_dir, f"epoch{epoch}"))
+            for out in loader:
+                writer.write(out)
+            writer.close()
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as out_file:
+        json.dump({"key": key}, out_file, indent=2)
+    os.replace(tmp_dir, save_dir)
+    logger.info(f"Pre-sampled epochs are saved at {save_dir}")
+
+
+class PresampledLoader:
+    """Replay pre-sampled epochs of a NeighborLoader without sampling.
+
+    Epoch `e` (set with `set_epoch`) replays the saved epoch (e - 1) % num_epochs.
+    Batches are memory-mapped and built by the loader's own `filter_fn`, so they
+    are the same as freshly sampled ones (features, feature cache, transforms).
+    Other attributes come from the wrapped loader.
+    """
+
+    def __init__(self, loader, save_dir, num_epochs):
+        self.loader = loader
+        self.save_dir = save_dir
+        self.num_epochs = num_epochs
+        self.epoch = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        epoch_dir = os.path.join(self.save_dir, f"epoch{(self.epoch - 1) % self.num_epochs}")
+        arrays = load_epoch(epoch_dir)
+        node_ptr, edge_ptr, input_ptr = arrays["node_ptr"].tolist(), arrays["edge_ptr"].tolist(), arrays["input_ptr"].tolist()
+        for i in range(len(node_ptr) - 1):
+            edges = slice(edge_ptr[i], edge_ptr[i + 1])
+            out = SamplerOutput(
+                node=arrays["node"][node_ptr[i]:node_ptr[i + 1]],
+                row=arrays["row"][edges].long(),
+                col=arrays["col"][edges].long(),
+                edge=arrays["edge"][edges] if "edge" in arrays else None,
+                num_sampled_nodes=arrays["num_sampled_nodes"][i].tolist(),
+                num_sampled_edges=arrays["num_sampled_edges"][i].tolist(),
+                metadata=(arrays["input_id"][input_ptr[i]:input_ptr[i + 1]], None),
+            )
+            yield self.loader.filter_fn(out)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def get_presampled_loader(train_loader, config):
+    """Replace a node-wise training loader by the replay of `presample_epochs` pre-sampled epochs."""
+    general_config = config["general_config"]
+    if general_config["sampling_strategy"] not in ["SAGE", None, "None"]:
+        logger.warning("Pre-sampling is only supported for node-wise sampling (SAGE, None).")
+        return train_loader
+
+    num_epochs = general_config["presample_epochs"]
+    save_dir, key = get_presample_dir(config, train_loader)
+    if not os.path.exists(save_dir):
+        presample(train_loader, save_dir, key, num_epochs, general_config["seed"] + get_rank())
+    else:
+        logger.info(f"Replaying pre-sampled epochs from {save_dir}")
+    return PresampledLoader(train_loader, save_dir, num_epochs)
+
+
+def _ptr(counts):
+    ptr = torch.zeros(len(counts) + 1, dtype=torch.long)
+    ptr[1:] = torch.tensor(counts, dtype=torch.long).cumsum(0)
+    return ptr
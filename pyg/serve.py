@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import queue
+import socketserver
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from .data_utils import get_inference_data_SAGE, get_inference_loader_SAGE
+from .inference import overwrite_model_config, get_probabilities
+from .train_utils import get_autocast, get_input_features, get_general_option
+
+from mlflow import MlflowClient
+from mlflow.pytorch import load_model as load_pyt_model
+
+from loguru import logger
+
+
+class LatencyStats:
+    """Latency percentiles and throughput over the last `window` requests and micro-batches.
+
+    The throughput is measured between the first and the last completion in
+    the window, so that idle time before or between bursts does not dilute it.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        # Completion time, number of requests and of nodes of each micro-batch.
+        self.batches = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_nodes = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, latencies, num_nodes, done):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batches.append((done, len(latencies), num_nodes))
+            self.num_requests += len(latencies)
+            self.num_nodes += num_nodes
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            batches = np.array(self.batches, dtype=np.float64).reshape(-1, 3)
+        # The requests of the first micro-batch completed before the window opened.
+        elapsed = batches[-1, 0] - batches[0, 0] if len(batches) > 1 else 0.0
+        return {
+            "requests": self.num_requests,
+            "nodes": self.num_nodes,
+            "p50 latency ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99 latency ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "requests per s": float(batches[1:, 1].sum() / elapsed) if elapsed > 0 else None,
+            "nodes per s": float(batches[1:, 2].sum() / elapsed) if elapsed > 0 else None,
+            "mean micro-batch nodes": float(batches[:, 2].mean()) if len(batches) else None,
+        }
+
+
+class MicroBatcher:
+    """Coalesce concurrent scoring requests into micro-batches.
+
+    A single worker thread takes the first pending request and waits at most
+    `max_wait` seconds for more, until the micro-batch holds `max_batch_nodes`
+    nodes. The distinct nodes of the micro-batch are scored with one call of
+    `score_fn`, and every request gets the rows of its own nodes.
+    """
+
+    def __init__(self, score_fn, max_batch_nodes=1024, max_wait=0.005):
+        self.score_fn = score_fn
+        self.max_batch_nodes = max_batch_nodes
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, nodes: torch.Tensor) -> Future:
+        future = Future()
+        self.requests.put((nodes, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            num_nodes = request[0].numel()
+            deadline = time.perf_counter() + self.max_wait
+            while num_nodes < self.max_batch_nodes:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                num_nodes += request[0].numel()
+            self._score(batch)
+
+    def _score(self, batch):
+        try:
+            nodes, inverse = torch.unique(torch.cat([nodes for nodes, _, _ in batch]), return_inverse=True)
+            outputs = self.score_fn(nodes)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        done = time.perf_counter()
+        for request_nodes, future, start in batch:
+            rows = inverse[offset:offset + request_nodes.numel()]
+            offset += request_nodes.numel()
+            future.set_result({key: value[rows] for key, value in outputs.items()})
+        self.stats.add_batch([done - start for _, _, start in batch], nodes.numel(), done)
+
+
+class Scorer:
+    """Score nodes of `data` with one sampled forward pass, through the sampler of an inference loader."""
+
+    def __init__(self, model, loader, device="cpu", multilabel=False, threshold=0, precision="fp32"):
+        self.model = model.to(device).eval()
+        self.loader = loader
+        self.device = device
+        self.multilabel = multilabel
+        self.threshold = threshold
+        self.precision = precision
+        self.num_nodes = loader.data.num_nodes
+
+    @torch.no_grad()
+    def __call__(self, nodes):
+        # Seeds of the loader are all nodes, so the index of a seed is its node id.
+        batch = self.loader.collate_fn(nodes)
+        if not self.loader.filter_per_worker:
+            batch = self.loader.filter_fn(batch)
+        x = get_input_features(batch.x, self.device, self.precision)
+        with get_autocast(self.device, self.precision):
+            outputs = self.model(x, batch.edge_index.to(self.device))[:batch.batch_size]
+        outputs = outputs.float().cpu()
+        preds = outputs > self.threshold if self.multilabel else outputs.argmax(dim=-1)
+        return {"pred": preds, "prob": get_probabilities(outputs, self.multilabel)}
+
+
+def get_handler(batcher: MicroBatcher, num_nodes):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        """POST /score with {"nodes": [...]} returns their predictions and probabilities; GET /stats the latency report."""
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            self._reply(200, batcher.stats.report())
+
+        def do_POST(self):
+            if self.path != "/score":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                nodes = torch.as_tensor(body["nodes"], dtype=torch.long).view(-1)
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {"error": f"Expected a JSON body {{\"nodes\": [node ids]}}: {e}"})
+            if nodes.numel() == 0 or nodes.min() < 0 or nodes.max() >= num_nodes:
+                return self._reply(400, {"error": f"Node ids must be in [0, {num_nodes})."})
+
+            try:
+                result = batcher.submit(nodes).result()
+            except Exception as e:
+                logger.exception(e)
+                return self._reply(500, {"error": str(e)})
+            self._reply(200, {"nodes": nodes.tolist(), **{key: value.tolist() for key, value in result.items()}})
+
+        def _reply(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # Unix socket clients have no address.
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    return ScoringHandler
+
+
+class ScoringHTTPServer(ThreadingHTTPServer):
+    # Concurrent clients should not be refused while the handlers wait for their micro-batch.
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        # Attributes used by BaseHTTPRequestHandler.
+        self.server_name, self.server_port = "localhost", 0
+
+
+def serve_gnn(config):
+    vargs = config["vargs"]
+    model_name, version = vargs["model"], vargs["version"]
+
+    if version is None:
+        client = MlflowClient()
+        model_metadata = client.get_registered_model(model_name)
+        version = model_metadata.latest_versions[0].version
+
+    dst_path = f"./registered_models/{model_name}/{version}"
+    if not os.path.exists(dst_path):
+        os.makedirs(dst_path)
+    logger.info(f"Model is saved at {dst_path}")
+    model = load_pyt_model(
+        model_uri=f'models:/{model_name}/{version}',
+        dst_path=dst_path
+    )
+
+    # Need to overwrite the model configs from the loaded model
+    overwrite_model_config(model, config)
+    general_config = config["general_config"]
+    dataset_config = config["dataset_config"]
+
+    # The graph and its sampler are loaded once; every node of the graph can be scored.
+    data = get_inference_data_SAGE(config)
+    data.infer_mask = torch.ones(data.num_nodes, dtype=torch.bool)
+    _, loader = get_inference_loader_SAGE(data, config)
+    scorer = Scorer(
+        model,
+        loader,
+        device=general_config["device"],
+        multilabel=dataset_config["task_type"].startswith("multi"),
+        precision=get_general_option(config, "precision", "fp32"),
+    )
+    batcher = MicroBatcher(scorer, max_batch_nodes=vargs["max_batch_nodes"], max_wait=vargs["max_wait_ms"] / 1e3)
+
+    handler = get_handler(batcher, scorer.num_nodes)
+    if vargs["unix_socket"]:
+        server = ThreadingUnixHTTPServer(vargs["unix_socket"], handler)
+        logger.info(f"Scoring {model_name} v{version} on {config['dataset']} at unix socket {vargs['unix_socket']}")
+    else:
+        server = ScoringHTTPServer((vargs["host"], vargs["port"]), handler)
+        logger.info(f"Scoring {model_name} v{version} on {config['dataset']} at http://{vargs['host']}:{vargs['port']}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        logger.info(f"Scoring stats: {batcher.stats.report()}")
@@ -1,34 +1,103 @@
 import torch
 import copy
+import contextlib
 
 from loguru import logger
 from .model.GraphSAGE import GraphSAGE_PyG
 from .model.GAT import GAT_PyG, GAT_Custom
+from .model.GIN import GIN_PyG
 
-def get_class_pos_weights(dataset_config, train_loader):
-    total_num = 0
-    pos_cnt = torch.zeros(dataset_config["num_classes"], dtype=int)
-    for batch in train_loader:
-        total_num += batch.y.shape[0]
-        pos_cnt = pos_cnt + batch.y.sum(axis=0)
-    neg_cnt = total_num - pos_cnt
-    return neg_cnt/pos_cnt
-        
-
-def get_loss_fn(config, train_loader, reduction="sum"):
+def get_loss_fn(config, class_stats, reduction="sum"):
+    """Loss of the task. `class_stats` are the class statistics of the training labels (see class_stats.py)."""
     dataset_config = config["dataset_config"]
     if dataset_config["task_type"] == "single-label-NC":
         return torch.nn.CrossEntropyLoss(reduction=reduction)
     
     elif dataset_config["task_type"] == "multi-label-NC":
         if config["hyperparameters"]["weighted_BCE"]:
-            pos_weight = get_class_pos_weights(dataset_config, train_loader)
+            pos_weight = torch.tensor(class_stats["pos_weight"])
         else:
             pos_weight = torch.ones(dataset_config["num_classes"])
         return torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight, reduction=reduction)
     else:
         logger.exception(NotImplementedError("Unsupported task type!"))
     
+def get_batch_mask(batch, mode, sampling_strategy):
+    """Nodes of `batch` on which predictions are made."""
+    if sampling_strategy in ["SAINT", "Cluster"] and mode == "train":
+        # Subgraph sampling: every training node of the sampled subgraph.
+        return batch.train_mask
+    elif sampling_strategy in ["GraphBatching"]:
+        return torch.ones(batch.x.shape[0], dtype=bool)
+    # Seed nodes come first in NeighborLoader batches, so a slice selects them without a gather.
+    return slice(0, batch.batch_size)
+
+
+def get_weighted_loss(node_loss_fn, outputs, targets, node_weight):
+    """Self-normalized node-weighted loss, e.g., with GraphSAINT's node_norm.
+
+    `node_loss_fn` must be created with reduction="none".
+    """
+    loss = node_loss_fn(outputs, targets)
+    if loss.dim() > 1:
+        loss = loss.mean(dim=-1)
+    return (loss * node_weight).sum() / node_weight.sum()
+
+
+def get_autocast(device, precision="fp32"):
+    """Autocast context of the forward pass. bf16 needs no loss scaling, as it has the exponent range of fp32."""
+    if precision == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def get_input_features(x, device, precision="fp32"):
+    """Move input features to `device`. Features cached in bf16 are upcast unless computing in bf16."""
+    x = x.to(device)
+    return x if precision == "bf16" else x.float()
+
+
+def get_general_option(config, key, default=None):
+    """Read a general option, giving priority to the command line.
+
+    Evaluation and inference replace general_config with the archived one of the
+    loaded model, which may predate newer options.
+    """
+    value = config.get("vargs", {}).get(key)
+    if value is None:
+        value = config["general_config"].get(key, default)
+    return value
+
+
+def use_layerwise_inference(config, model):
+    """Whether val/test/inference predictions can be computed layer by layer.
+
+    Layer-wise inference is exact only when all neighbors are used for prediction,
+    so it is restricted to unsampled prediction over node-level loaders.
+    """
+    general_config = config["general_config"]
+    return (
+        get_general_option(config, "layerwise_inference", True)
+        and not general_config["sample_when_predict"]
+        and general_config["sampling_strategy"] in ["SAGE", "SAINT", "Cluster", None, "None"]
+        and getattr(model, "supports_layerwise_inference", False)
+    )
+
+
+def should_eval_test(general_config, epoch, improved):
+    """Whether to evaluate the test split after the validation step of `epoch`.
+
+    test_eval_mode "always" tests every epoch, "on_improve" only when validation improves
+    and "end" once on the best weights after training. In addition, the test split is
+    evaluated every test_eval_every epochs if set.
+    """
+    test_eval_mode = general_config["test_eval_mode"]
+    test_eval_every = general_config["test_eval_every"]
+    if test_eval_every and epoch % test_eval_every == 0:
+        return True
+    return test_eval_mode == "always" or (test_eval_mode == "on_improve" and improved)
+
+
 def filter_config_for_archive(config):
     archive_config = {
         "general_config": copy.deepcopy(config["general_config"]),
@@ -89,7 +158,19 @@ def get_model(config):
             )
 
         case "GIN_PyG":
-            pass
+            model = GIN_PyG(
+                in_channels=dataset_config["num_node_features"],
+                out_channels=dataset_config["num_classes"],
+                hidden_channels=model_config.pop("hidden_node_channels"),
+                num_layers=model_config.pop("num_layers"),
+                num_lin_layers=model_config.pop("num_lin_layers", 2),
+                eps=model_config.pop("eps", 0.),
+                train_eps=model_config.pop("train_eps", False),
+                dropout=model_config.pop("dropout", 0),
+                mlp_dropout=model_config.pop("mlp_dropout", 0),
+                config=archive_config,
+                **model_config,
+            )
         case _:
             logger.exception(
                 f"Unreconized base model: {model_config['base_model']}")
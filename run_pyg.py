@@ -5,6 +5,8 @@ from utils import create_parser, set_global_seed, setup_mlflow, setup_logger, in
 from pyg.train import train_gnn
 from pyg.inference import infer_gnn
 from pyg.evaluate import eval_gnn
+from pyg.serve import serve_gnn
+from pyg.distributed import launch
 
 def main():
     
@@ -28,13 +30,19 @@ def main():
     set_global_seed(config["general_config"]["seed"])
     
     if args.mode == 'train':
-        train_gnn(config)
+        if config["general_config"]["nprocs"] > 1:
+            launch(train_gnn, config, config["general_config"]["nprocs"])
+        else:
+            train_gnn(config)
     
     if args.mode == 'evaluate':
         eval_gnn(config)
     
     elif args.mode == 'inference':
         infer_gnn(config)
+
+    elif args.mode == 'serve':
+        serve_gnn(config)
     
     
 
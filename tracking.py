@@ -0,0 +1,227 @@
+import os
+import json
+import glob
+import time
+import fcntl
+import queue
+import threading
+
+import mlflow
+
+from mlflow import MlflowClient
+from mlflow.entities import Metric, Param
+from mlflow.exceptions import RestException
+from loguru import logger
+
+
+# Limits of a single MlflowClient.log_batch request (at most 1000 metrics, 100 params and 1000 entities in total).
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_PER_BATCH = 100
+
+
+def split_batch(metrics, params):
+    """Chunks of a batch that each stay within the limits of one log_batch request."""
+    for start in range(0, len(params), MAX_PARAMS_PER_BATCH):
+        yield [], params[start:start + MAX_PARAMS_PER_BATCH]
+    for start in range(0, len(metrics), MAX_METRICS_PER_BATCH):
+        yield metrics[start:start + MAX_METRICS_PER_BATCH], []
+
+
+class AsyncMLflowLogger:
+    """Log metrics and params of an MLflow run from a background thread.
+
+    Records are queued by the training loop and sent with `log_batch` every
+    `flush_interval` seconds. Batches that cannot be sent (e.g. the tracking
+    server is unreachable) are appended to a spool file under `spool_dir`,
+    which is replayed once the server is reachable again, or by the next run.
+    Batches rejected by the server itself are dropped with an error. Params
+    and metrics are sent in separate requests within the MLflow limits.
+
+    Each logger holds an exclusive lock on its spool file (`<run_id>.lock`)
+    while it runs, so that a new run only replays the spool files of runs
+    that have ended and no spool file is replayed twice.
+    """
+
+    def __init__(self, run_id, spool_dir="logs/mlflow_spool", flush_interval=5.0):
+        self.run_id = run_id
+        self.spool_dir = spool_dir
+        self.spool_path = os.path.join(spool_dir, f"{run_id}.jsonl")
+        self.flush_interval = flush_interval
+        self.client = MlflowClient()
+        os.makedirs(spool_dir, exist_ok=True)
+        self.lock_file = open(os.path.join(spool_dir, f"{run_id}.lock"), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="mlflow-logger", daemon=True)
+        self.thread.start()
+
+    def log_metric(self, key, value, step=None):
+        self.queue.put(("metric", Metric(key, float(value), int(time.time() * 1000), step or 0)))
+
+    def log_params(self, params):
+        for key, value in params.items():
+            self.queue.put(("param", Param(key, str(value))))
+
+    def flush(self):
+        """Block until every record queued so far has been sent or spooled."""
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        # Do not wait forever on a logging thread that died.
+        while not done.wait(1) and self.thread.is_alive():
+            pass
+
+    def close(self):
+        try:
+            self.flush()
+            self.queue.put(("stop", None))
+            self.thread.join()
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            os.remove(self.lock_file.name)
+
+    def _run(self):
+        self._replay_ended_runs()
+        metrics, params = [], []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                kind, item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                kind, item = "timeout", None
+
+            if kind == "metric":
+                metrics.append(item)
+            elif kind == "param":
+                params.append(item)
+
+            if kind not in ("metric", "param") or len(metrics) >= MAX_METRICS_PER_BATCH or len(params) >= MAX_PARAMS_PER_BATCH:
+                self._send(self.run_id, metrics, params)
+                metrics, params = [], []
+                deadline = time.monotonic() + self.flush_interval
+
+            if kind == "flush":
+                item.set()
+            elif kind == "stop":
+                # Last attempt at what was spooled while the server was unreachable.
+                if os.path.exists(self.spool_path):
+                    self._replay_spool(self.spool_path)
+                return
+
+    def _send(self, run_id, metrics, params):
+        if not metrics and not params:
+            return
+        chunks = list(split_batch(metrics, params))
+        for i, (chunk_metrics, chunk_params) in enumerate(chunks):
+            try:
+                self.client.log_batch(run_id, metrics=chunk_metrics, params=chunk_params)
+            except RestException as e:
+                logger.error(f"MLflow server rejected {len(chunk_metrics)} metrics and {len(chunk_params)} params: {e}")
+            except Exception as e:
+                logger.warning(f"Failed to log to the MLflow server, spooling to {self.spool_path}: {e}")
+                for chunk_metrics, chunk_params in chunks[i:]:
+                    self._spool(run_id, chunk_metrics, chunk_params)
+                return
+        if os.path.exists(self.spool_path):
+            self._replay_spool(self.spool_path)
+
+    def _spool(self, run_id, metrics, params):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        record = {
+            "run_id": run_id,
+            "metrics": [[m.key, m.value, m.timestamp, m.step] for m in metrics],
+            "params": [[p.key, p.value] for p in params],
+        }
+        with open(self.spool_path, "a") as out_file:
+            out_file.write(json.dumps(record) + "\n")
+
+    def _replay_ended_runs(self):
+        """At start-up, replay this run's spool and those of earlier runs that ended before the server came back.
+
+        The spool file of a run still logging (locked by its logger) is left to it.
+        """
+        for path in glob.glob(os.path.join(self.spool_dir, "*.jsonl")):
+            if path == self.spool_path:
+                self._replay_spool(path)
+                continue
+            with open(path[:-len(".jsonl")] + ".lock", "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    if os.path.exists(path):
+                        self._replay_spool(path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            if not os.path.exists(path):
+                os.remove(lock_file.name)
+
+    def _replay_spool(self, path):
+        with open(path) as in_file:
+            # A line without newline was cut off by a crash while spooling.
+            records = [json.loads(line) for line in in_file if line.endswith("\n")]
+        for i, record in enumerate(records):
+            try:
+                self.client.log_batch(
+                    record["run_id"],
+                    metrics=[Metric(*m) for m in record["metrics"]],
+                    params=[Param(*p) for p in record["params"]],
+                )
+            except RestException as e:
+                logger.error(f"MLflow server rejected a spooled batch of run {record['run_id']}: {e}")
+            except Exception:
+                # Still unreachable: keep the records not sent yet for the next attempt.
+                with open(path, "w") as out_file:
+                    out_file.writelines(json.dumps(r) + "\n" for r in records[i:])
+                return
+        os.remove(path)
+        logger.info(f"Replayed {len(records)} spooled MLflow batches from {path}.")
+
+
+_active_logger = None
+_enabled = True
+
+
+def set_enabled(enabled):
+    """Turn logging on or off in this process, e.g. off on all but the main process of distributed training."""
+    global _enabled
+    _enabled = enabled
+
+
+def start_async_logging(run_id, spool_dir="logs/mlflow_spool", flush_interval=5.0):
+    global _active_logger
+    _active_logger = AsyncMLflowLogger(run_id, spool_dir=spool_dir, flush_interval=flush_interval)
+    return _active_logger
+
+
+def end_async_logging():
+    global _active_logger
+    if _active_logger is not None:
+        try:
+            _active_logger.close()
+        finally:
+            _active_logger = None
+
+
+def flush():
+    if _active_logger is not None:
+        _active_logger.flush()
+
+
+def log_metric(key, value, step=None):
+    if not _enabled:
+        return
+    if _active_logger is not None:
+        _active_logger.log_metric(key, value, step)
+    else:
+        mlflow.log_metric(key, value, step)
+
+
+def log_params(params):
+    if not _enabled:
+        return
+    if _active_logger is not None:
+        _active_logger.log_params(params)
+    else:
+        mlflow.log_params(params)
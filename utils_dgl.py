@@ -29,18 +29,41 @@ def add_train_parser(subparsers: argparse._SubParsersAction, parent_parser: argp
         '--sampling_strategy', choices=config.sampling_strategy_options, default=None)
     general_config.add_argument(
         '--SAGE_inductive_option', choices=config.SAGE_inductive_options, default=None)
+    general_config.add_argument(
+        '--SAINT_sampler', choices=config.SAINT_sampler_options, default=None)
+    general_config.add_argument('--SAINT_walk_length', type=int, default=None)
+    general_config.add_argument('--SAINT_num_steps', type=int, default=None)
+    general_config.add_argument('--SAINT_sample_coverage', type=int, default=None)
+    general_config.add_argument('--Cluster_num_parts', type=int, default=None)
+    general_config.add_argument('--Cluster_parts_per_batch', type=int, default=None)
     general_config.add_argument(
         '--sample_when_predict', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument(
+        '--layerwise_inference', action=argparse.BooleanOptionalAction, default=None)
     general_config.add_argument('--seed', type=int, default=None)
     general_config.add_argument('--device', default=None)
+    general_config.add_argument(
+        '--precision', choices=config.precision_options, default=None)
+    general_config.add_argument(
+        '--compile', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument('--feature_cache_size', type=int, default=None)
     general_config.add_argument('--tqdm', action="store_true", default=None)
     general_config.add_argument(
         '--save_model', action="store_true", default=None)
+    general_config.add_argument('--checkpoint_debounce', type=float, default=None)
+    general_config.add_argument('--checkpoint_keep', type=int, default=None)
+    general_config.add_argument(
+        '--resume', default=None, metavar="RUN_ID", help="Resume an interrupted training run from its last checkpoint.")
     general_config.add_argument(
         '--criterion', type=str, default=None, choices=["loss", "accuracy", "f1"])
     general_config.add_argument('--num_epochs', type=int, default=None)
     general_config.add_argument('--patience', type=int, default=None)
+    general_config.add_argument(
+        '--test_eval_mode', choices=config.test_eval_mode_options, default=None)
+    general_config.add_argument('--test_eval_every', type=int, default=None)
     general_config.add_argument('--num_workers', type=int, default=None)
+    general_config.add_argument(
+        '--async_logging', action=argparse.BooleanOptionalAction, default=None)
 
     # General hyperparameters
     hyperparameters = parser.add_argument_group("Global Hyperparameters")
@@ -77,6 +100,12 @@ def add_inference_parser(subparsers: argparse._SubParsersAction, parent_parser:
     
     parser.add_argument('--split', choices=["train", "val", "test", "unlabelled"], default="test", help='Select the split of the data set to predict. Supported values [train, val, test] for labelled split, and [unlabelled] for unlabelled split. The dataset should be able to loaded as a pytorch geometric dataset, and each data object has the attribute {split_name}_mask to get the split for inference. ')
     parser.add_argument('--output_dir', default="./output")
+    parser.add_argument('--output_format', choices=["parquet", "arrow"], default="parquet",
+                        help='Predictions are streamed batch by batch to a Parquet or Arrow IPC file.')
+    parser.add_argument('--write_probs', action=argparse.BooleanOptionalAction, default=False,
+                        help='Also write the class probabilities.')
+    parser.add_argument('--write_truths', action=argparse.BooleanOptionalAction, default=True,
+                        help='Also write the truths of a labelled split.')
     
     # General settings
     general_config = parser.add_argument_group("Global Settigns")
@@ -88,8 +117,15 @@ def add_inference_parser(subparsers: argparse._SubParsersAction, parent_parser:
         '--SAGE_inductive_option', choices=config.SAGE_inductive_options, default=None)
     general_config.add_argument(
         '--sample_when_predict', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument(
+        '--layerwise_inference', action=argparse.BooleanOptionalAction, default=None)
     general_config.add_argument('--seed', type=int, default=None)
     general_config.add_argument('--device', default=None)
+    general_config.add_argument(
+        '--precision', choices=config.precision_options, default=None)
+    general_config.add_argument(
+        '--compile', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument('--feature_cache_size', type=int, default=None)
     general_config.add_argument('--tqdm', action="store_true", default=None)
 
 def add_evaluate_parser(subparsers: argparse._SubParsersAction, parent_parser: argparse.ArgumentParser, config: config_dgl):
@@ -114,8 +150,15 @@ def add_evaluate_parser(subparsers: argparse._SubParsersAction, parent_parser: a
         '--SAGE_inductive_option', choices=config.SAGE_inductive_options, default=None)
     general_config.add_argument(
         '--sample_when_predict', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument(
+        '--layerwise_inference', action=argparse.BooleanOptionalAction, default=None)
     general_config.add_argument('--seed', type=int, default=None)
     general_config.add_argument('--device', default=None)
+    general_config.add_argument(
+        '--precision', choices=config.precision_options, default=None)
+    general_config.add_argument(
+        '--compile', action=argparse.BooleanOptionalAction, default=None)
+    general_config.add_argument('--feature_cache_size', type=int, default=None)
     general_config.add_argument('--tqdm', action="store_true", default=None)
     
 